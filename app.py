@@ -1,19 +1,35 @@
-from flask import Flask, render_template, request, send_file, jsonify, session, redirect, url_for
+from flask import Flask, render_template, request, send_file, jsonify, session, redirect, url_for, Response, g
 import os
+import json
+import shutil
+import hashlib
 import time
 from datetime import datetime, timedelta
 import threading
-import subprocess
 import logging
+from logging.handlers import RotatingFileHandler
 from functools import wraps
 import secrets
+import uuid
+import multiprocessing
+from queue import SimpleQueue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+# Log file, rotated to app.log.1 ... app.log.<LOG_BACKUP_COUNT> when it
+# reaches LOG_MAX_BYTES
+LOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.log')
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('app.log'),
+        RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'),
         logging.StreamHandler()
     ]
 )
@@ -21,9 +37,44 @@ logger = logging.getLogger(__name__)
 
 # Configuration
 WORKING_DIR = os.path.dirname(os.path.abspath(__file__))  # Текущая директория скрипта
-SKLAD_FILE = os.path.join(WORKING_DIR, "sklad.xlsx")
-REESTR_FILE = os.path.join(WORKING_DIR, "reestr.xlsx")
-RESULT_FILE = os.path.join(WORKING_DIR, "exit.xlsx")
+# Workspaces: JOBS_DIR/<job_id>/ holds the sklad.xlsx, reestr.xlsx and
+# exit.xlsx of one job
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(WORKING_DIR, 'jobs'))
+WORKSPACE_FILES = ['sklad.xlsx', 'reestr.xlsx', 'exit.xlsx']
+# Result cache: RESULT_CACHE_DIR/<key>.xlsx, key = hash of both input files
+# and transform_data.result_settings(); least recently used results are
+# evicted above RESULT_CACHE_MAX_BYTES (0 disables the cache)
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(WORKING_DIR, 'cache'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+
+# Job runner: worker processes running transform_data.main() and the limit
+# of jobs waiting or running at the same time
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 4))
+# Resident reestr: keep the last reestr loaded and indexed in the app process
+# (loaded again only for a different reestr.xlsx) and run the jobs in a
+# thread of the app process against it instead of in the worker processes
+RESIDENT_REESTR = os.environ.get('RESIDENT_REESTR', '0') == '1'
+# Most items /match accepts in one request
+MATCH_API_MAX_ITEMS = int(os.environ.get('MATCH_API_MAX_ITEMS', 1000))
+# Seconds /job_events waits for a job change before checking the job again
+JOB_EVENTS_POLL = float(os.environ.get('JOB_EVENTS_POLL', 1))
+# /get_logs: lines returned without a cursor (at most LOG_TAIL_MAX_LINES on
+# request), bytes read per backward seek and the most bytes of new lines
+# returned per call
+LOG_TAIL_LINES = int(os.environ.get('LOG_TAIL_LINES', 50))
+LOG_TAIL_MAX_LINES = int(os.environ.get('LOG_TAIL_MAX_LINES', 1000))
+LOG_BLOCK_SIZE = 64 * 1024
+LOG_READ_MAX_BYTES = int(os.environ.get('LOG_READ_MAX_BYTES', 1024 * 1024))
+
+# Request latency of /upload, /download, /start and /match and sizes of the
+# files handled by /upload, /download and /start
+METERED_ENDPOINTS = {'upload_file': '/upload', 'download_file': '/download', 'start_process': '/start',
+                     'match_items': '/match'}
+REQUEST_SECONDS = metrics.Histogram('app_request_seconds', 'Latency of /upload, /download, /start and /match',
+                                    metrics.DURATION_BUCKETS, labels=('endpoint',))
+FILE_BYTES = metrics.Histogram('app_file_bytes', 'Size of the files uploaded, downloaded and processed',
+                               metrics.SIZE_BUCKETS, labels=('endpoint', 'file'))
 
 app = Flask(__name__)
 # Фиксированный ключ для стабильности сессий
@@ -47,8 +98,8 @@ def login_required(f):
         if 'user' not in session or not session['user']:
             logger.info(f"No valid session for {request.endpoint}")
             
-            # Для AJAX запросов (определяем по заголовку)
-            if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            # Для AJAX и JSON запросов (определяем по заголовкам)
+            if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.is_json:
                 return jsonify({'status': 'error', 'message': 'Требуется авторизация'}), 401
             
             # Для обычных запросов - редирект
@@ -58,25 +109,350 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def workspace_dir(job_id):
+    return os.path.join(JOBS_DIR, job_id)
+
+def workspace_file(job_id, filename):
+    return os.path.join(workspace_dir(job_id), filename)
+
+def current_job_id(create=False):
+    """Job ID of the session's workspace, created on demand."""
+    job_id = session.get('job_id')
+    if job_id is None and create:
+        job_id = uuid.uuid4().hex
+        session['job_id'] = job_id
+        logger.info(f"Created workspace for job {job_id}")
+    return job_id
+
+def remove_workspace_if_empty(job_id):
+    directory = workspace_dir(job_id)
+    try:
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+    except OSError as e:
+        logger.error(f"Error removing workspace {job_id}: {str(e)}")
+
+def result_cache_key(job_id):
+    """Cache key of the result for the input files in the workspace of job_id."""
+    import transform_data
+    digest = hashlib.sha256()
+    for filename in ('sklad.xlsx', 'reestr.xlsx'):
+        digest.update(transform_data.file_digest(workspace_file(job_id, filename)).encode())
+    digest.update(json.dumps(transform_data.result_settings(), sort_keys=True).encode())
+    return digest.hexdigest()
+
+def cached_result_path(cache_key):
+    return os.path.join(RESULT_CACHE_DIR, f'{cache_key}.xlsx')
+
+def restore_cached_result(cache_key, result_file):
+    """Copy the cached result for cache_key to result_file; False on a cache miss."""
+    if not RESULT_CACHE_MAX_BYTES:
+        return False
+    cached_file = cached_result_path(cache_key)
+    try:
+        shutil.copyfile(cached_file, result_file)
+        os.utime(cached_file)  # mtime is the last use for LRU eviction
+        return True
+    except OSError:
+        return False
+
+def store_cached_result(cache_key, result_file):
+    if not RESULT_CACHE_MAX_BYTES:
+        return
+    try:
+        os.makedirs(RESULT_CACHE_DIR, exist_ok=True)
+        temp_file = cached_result_path(f'{cache_key}.{uuid.uuid4().hex}.tmp')
+        shutil.copyfile(result_file, temp_file)
+        os.replace(temp_file, cached_result_path(cache_key))
+        logger.info(f"Cached result {cache_key}")
+    except OSError as e:
+        logger.error(f"Error caching result {cache_key}: {str(e)}")
+        return
+    evict_result_cache()
+
+def evict_result_cache():
+    """Remove least recently used results until the cache fits RESULT_CACHE_MAX_BYTES."""
+    if not os.path.isdir(RESULT_CACHE_DIR):
+        return
+    entries = []
+    for filename in os.listdir(RESULT_CACHE_DIR):
+        try:
+            stat = os.stat(os.path.join(RESULT_CACHE_DIR, filename))
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, filename))
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, filename in sorted(entries):
+        if total_size <= RESULT_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(os.path.join(RESULT_CACHE_DIR, filename))
+            logger.info(f"Evicted cached result: {filename}")
+        except OSError as e:
+            logger.error(f"Error evicting cached result {filename}: {str(e)}")
+        total_size -= size
+
 def cleanup_old_files():
     while True:
         current_time = datetime.now()
-        for filename in ['sklad.xlsx', 'reestr.xlsx', 'exit.xlsx']:
-            filepath = os.path.join(WORKING_DIR, filename)
-            if os.path.exists(filepath):
-                file_time = datetime.fromtimestamp(os.path.getmtime(filepath))
-                if current_time - file_time > timedelta(hours=1):
-                    try:
-                        os.remove(filepath)
-                        logger.info(f"Removed old file: {filename}")
-                    except Exception as e:
-                        logger.error(f"Error removing file {filename}: {str(e)}")
+        job_ids = os.listdir(JOBS_DIR) if os.path.isdir(JOBS_DIR) else []
+        for job_id in job_ids:
+            if job_is_active(job_id):
+                continue
+            for filename in WORKSPACE_FILES:
+                filepath = workspace_file(job_id, filename)
+                if os.path.exists(filepath):
+                    file_time = datetime.fromtimestamp(os.path.getmtime(filepath))
+                    if current_time - file_time > timedelta(hours=1):
+                        try:
+                            os.remove(filepath)
+                            logger.info(f"Removed old file: {job_id}/{filename}")
+                        except Exception as e:
+                            logger.error(f"Error removing file {job_id}/{filename}: {str(e)}")
+            # Пустую папку удаляем, когда в ней час ничего не менялось
+            try:
+                dir_time = datetime.fromtimestamp(os.path.getmtime(workspace_dir(job_id)))
+            except OSError:
+                continue  # папку уже удалил /clear
+            if current_time - dir_time > timedelta(hours=1):
+                remove_workspace_if_empty(job_id)
+        remove_finished_jobs(current_time - timedelta(hours=1))
+        evict_result_cache()
         time.sleep(300)  # Check every 5 minutes
 
+# Jobs by ID: status ('queued', 'running', 'done', 'error'), times, error,
+# the last progress report of transform_data.main() and, once done, the
+# seconds of each stage of the run (transform_data.stage_timings)
+jobs = {}
+jobs_lock = threading.Lock()
+# Notified whenever a job gets a progress report or finishes
+jobs_changed = threading.Condition(jobs_lock)
+job_executor = None
+# (job_id, report) pairs sent by the workers, read by collect_progress()
+progress_queue = None
+_worker_progress_queue = None
+# Log records of the worker processes, written to app.log by this process
+log_queue = None
+
+def _init_job_worker(queue, worker_log_queue=None):
+    """Import transform_data once per worker so jobs don't pay for pandas/openpyxl imports."""
+    global _worker_progress_queue
+    _worker_progress_queue = queue
+    import transform_data
+    if worker_log_queue is not None:
+        transform_data.log_to_queue(worker_log_queue)
+
+class ResidentReestr:
+    """transform_data.ReestrSnapshot of the last reestr used, kept in the app process.
+
+    get(reestr_file) returns the snapshot of that file and loads it first
+    when the resident one is of a different file. The new snapshot replaces
+    the old one in a single assignment, so a job keeps the snapshot it got
+    while a newer reestr is loaded. Files are identified by their
+    reestr_cache_key; a file whose path, size and mtime were already found
+    to have the snapshot's key is not hashed again.
+    """
+
+    def __init__(self):
+        self._current = None  # (snapshot, {(path, size, mtime) of its files})
+        self._load_lock = threading.Lock()
+
+    @property
+    def snapshot(self):
+        current = self._current
+        return current[0] if current is not None else None
+
+    def get(self, reestr_file):
+        import transform_data
+        stat = os.stat(reestr_file)
+        file_id = (os.path.abspath(reestr_file), stat.st_size, stat.st_mtime_ns)
+        current = self._current
+        if current is not None and file_id in current[1]:
+            return current[0]
+        cache_key = transform_data.reestr_cache_key(reestr_file)
+        if current is not None and current[0].cache_key == cache_key:
+            current[1].add(file_id)
+            return current[0]
+        with self._load_lock:
+            # Этот реестр мог загрузиться, пока ждали блокировку
+            current = self._current
+            if current is None or current[0].cache_key != cache_key:
+                started = time.monotonic()
+                snapshot = transform_data.load_reestr_snapshot(reestr_file)
+                current = self._current = (snapshot, {file_id})
+                logger.info(f"Loaded resident reestr {snapshot.cache_key}: {len(snapshot.reestr_df)} rows "
+                            f"in {time.monotonic() - started:.2f}s")
+            else:
+                current[1].add(file_id)
+        return current[0]
+
+resident_reestr = ResidentReestr()
+
+def preload_reestr(reestr_file):
+    """Load an uploaded reestr into resident_reestr before its job is started."""
+    try:
+        resident_reestr.get(reestr_file)
+    except Exception as e:
+        logger.error(f"Error loading resident reestr {reestr_file}: {str(e)}")
+
+def _run_transform_job(job_id, sklad_file, reestr_file, result_file):
+    """Start time and transform_data.job_summary of a run."""
+    import transform_data
+    started = datetime.now().isoformat()
+    reestr = resident_reestr.get(reestr_file) if RESIDENT_REESTR else None
+    summary = transform_data.main(sklad_file, reestr_file, result_file, reestr=reestr,
+                                  progress_callback=lambda report: _worker_progress_queue.put((job_id, report)))
+    return started, summary
+
+def collect_progress():
+    """Store the progress reports of the workers on their jobs."""
+    while True:
+        job_id, report = progress_queue.get()
+        with jobs_changed:
+            job = jobs.get(job_id)
+            if job is not None:
+                job['progress'] = report
+                jobs_changed.notify_all()
+
+def get_job_executor():
+    global job_executor, progress_queue, log_queue
+    if progress_queue is None:
+        progress_queue = SimpleQueue() if RESIDENT_REESTR else multiprocessing.Queue()
+        threading.Thread(target=collect_progress, daemon=True).start()
+    if job_executor is None and RESIDENT_REESTR:
+        # Сопоставление держит GIL, второй поток задачи не ускорит
+        job_executor = ThreadPoolExecutor(max_workers=1, initializer=_init_job_worker,
+                                          initargs=(progress_queue,))
+        logger.info("Started job thread with the resident reestr")
+    elif job_executor is None:
+        if log_queue is None:
+            import transform_data
+            log_queue = multiprocessing.Queue()
+            transform_data.start_log_listener(log_queue)
+        job_executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, initializer=_init_job_worker,
+                                           initargs=(progress_queue, log_queue))
+        logger.info(f"Started job worker pool with {JOB_WORKERS} workers")
+    return job_executor
+
+def refresh_job_status(job):
+    """Mark a queued job as running once a worker has taken it."""
+    if job['status'] == 'queued' and job['future'].running():
+        job['status'] = 'running'
+    return job['status']
+
+def job_is_active(job_id):
+    """Whether job_id is queued or running."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        return job is not None and refresh_job_status(job) in ('queued', 'running')
+
+def job_info(job_id):
+    """Public fields of a job for the JSON responses."""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return None
+        refresh_job_status(job)
+        return {key: value for key, value in job.items() if key != 'future'}
+
+def remove_finished_jobs(older_than):
+    """Forget finished jobs that ended before older_than."""
+    with jobs_lock:
+        for job_id in [job_id for job_id, job in jobs.items()
+                       if job['finished'] and datetime.fromisoformat(job['finished']) < older_than]:
+            del jobs[job_id]
+
+def _job_done(job_id, future):
+    import transform_data
+    with jobs_changed:
+        job = jobs[job_id]
+        job['finished'] = datetime.now().isoformat()
+        try:
+            job['started'], summary = future.result()
+            job['status'] = 'done'
+            job['timings'] = summary['timings']
+            # Этапы выполнялись в обработчике, в гистограмму - один раз на задачу
+            transform_data.observe_stage_timings(summary['timings'])
+            logger.info(f"Job {job_id} finished")
+        except Exception as e:
+            job['status'] = 'error'
+            job['error'] = str(e)
+            logger.error(f"Job {job_id} failed: {str(e)}")
+        jobs_changed.notify_all()
+        cache_key = job['cache_key'] if job['status'] == 'done' else None
+    if cache_key:
+        store_cached_result(cache_key, workspace_file(job_id, 'exit.xlsx'))
+
+def submit_job(job_id, cache_key):
+    """Queue a transform_data.main() run on the workspace of job_id.
+
+    Returns 'active' without queueing a second run if the job is already
+    queued or running, 'cached' if the result for cache_key was copied from
+    the result cache and the job is done, 'queued' otherwise. Raises
+    RuntimeError when JOB_QUEUE_SIZE jobs are already waiting.
+    """
+    global job_executor
+    with jobs_changed:
+        job = jobs.get(job_id)
+        if job is not None and refresh_job_status(job) in ('queued', 'running'):
+            return 'active'
+        if restore_cached_result(cache_key, workspace_file(job_id, 'exit.xlsx')):
+            now = datetime.now().isoformat()
+            jobs[job_id] = {
+                'status': 'done',
+                'submitted': now,
+                'started': now,
+                'finished': now,
+                'error': None,
+                'progress': {'stage': 'done', 'done': 0, 'total': None, 'eta': None},
+                'cache_key': cache_key,
+                'cached': True,
+                'timings': None,
+                'future': None,
+            }
+            jobs_changed.notify_all()
+            return 'cached'
+        pending = sum(1 for job in jobs.values() if refresh_job_status(job) in ('queued', 'running'))
+        if pending >= JOB_QUEUE_SIZE:
+            raise RuntimeError('Очередь обработки заполнена, попробуйте позже')
+
+        args = (job_id,) + tuple(workspace_file(job_id, filename) for filename in WORKSPACE_FILES)
+        try:
+            future = get_job_executor().submit(_run_transform_job, *args)
+        except BrokenProcessPool:
+            logger.warning("Job worker pool is broken, restarting it")
+            job_executor = None
+            future = get_job_executor().submit(_run_transform_job, *args)
+        jobs[job_id] = {
+            'status': 'queued',
+            'submitted': datetime.now().isoformat(),
+            'started': None,
+            'finished': None,
+            'error': None,
+            'progress': None,
+            'cache_key': cache_key,
+            'cached': False,
+            'timings': None,
+            'future': future,
+        }
+    future.add_done_callback(lambda f: _job_done(job_id, f))
+    return 'queued'
+
 # Start cleanup thread
 cleanup_thread = threading.Thread(target=cleanup_old_files, daemon=True)
 cleanup_thread.start()
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.monotonic()
+
+@app.after_request
+def observe_request_latency(response):
+    endpoint = METERED_ENDPOINTS.get(request.endpoint)
+    if endpoint and 'request_started' in g:
+        REQUEST_SECONDS.observe(time.monotonic() - g.request_started, endpoint=endpoint)
+    return response
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'xlsx'}
 
@@ -147,15 +523,22 @@ def upload_file():
         return jsonify({'status': 'error', 'message': 'Invalid file type'})
     
     file_type = request.form.get('type')
+    if file_type not in ('sklad', 'reestr'):
+        return jsonify({'status': 'error', 'message': 'Invalid file type'})
     target_filename = f"{file_type}.xlsx"
-    target_path = os.path.join(WORKING_DIR, target_filename)
+    job_id = current_job_id(create=True)
+    os.makedirs(workspace_dir(job_id), exist_ok=True)
+    target_path = workspace_file(job_id, target_filename)
     
     if os.path.exists(target_path):
         return jsonify({'status': 'error', 'message': f'File {target_filename} already exists'})
     
     try:
         file.save(target_path)
-        logger.info(f"File {target_filename} uploaded successfully")
+        FILE_BYTES.observe(os.path.getsize(target_path), endpoint='/upload', file=file_type)
+        logger.info(f"File {target_filename} uploaded successfully to job {job_id}")
+        if RESIDENT_REESTR and file_type == 'reestr':
+            threading.Thread(target=preload_reestr, args=(target_path,), daemon=True).start()
         return jsonify({'status': 'success', 'message': f'File {target_filename} uploaded successfully'})
     except Exception as e:
         logger.error(f"Error saving file {target_filename}: {str(e)}")
@@ -164,28 +547,32 @@ def upload_file():
 @app.route('/start', methods=['POST'])
 @login_required
 def start_process():
-    if not os.path.exists(SKLAD_FILE):
+    job_id = current_job_id()
+    if job_id is None or not os.path.exists(workspace_file(job_id, 'sklad.xlsx')):
         response = jsonify({'status': 'error', 'message': 'Файл sklad.xlsx не найден'})
         response.headers['Content-Type'] = 'application/json; charset=utf-8'
         return response
-    if not os.path.exists(REESTR_FILE):
+    if not os.path.exists(workspace_file(job_id, 'reestr.xlsx')):
         response = jsonify({'status': 'error', 'message': 'Файл reestr.xlsx не найден'})
         response.headers['Content-Type'] = 'application/json; charset=utf-8'
         return response
     
     try:
-        # Определяем команду Python в зависимости от ОС
-        import sys
-        python_cmd = sys.executable  # Использует тот же Python, что и Flask app
-        script_path = os.path.join(WORKING_DIR, 'transform_data.py')
-        
-        logger.info(f"Starting process: {python_cmd} {script_path}")
-        process = subprocess.Popen([python_cmd, script_path], 
-                                 stdout=subprocess.PIPE, 
-                                 stderr=subprocess.PIPE)
-        logger.info(f"Started process with PID: {process.pid}")
+        for file_type in ('sklad', 'reestr'):
+            FILE_BYTES.observe(os.path.getsize(workspace_file(job_id, f'{file_type}.xlsx')),
+                               endpoint='/start', file=file_type)
+        state = submit_job(job_id, result_cache_key(job_id))
+        if state == 'active':
+            logger.info(f"Job {job_id} is already active")
+            message = 'Обработка уже выполняется'
+        elif state == 'cached':
+            logger.info(f"Job {job_id} served from the result cache")
+            message = 'Результат взят из кэша'
+        else:
+            logger.info(f"Queued job {job_id}")
+            message = 'Processing started'
         
-        response = jsonify({'status': 'success', 'message': 'Processing started'})
+        response = jsonify({'status': 'success', 'message': message, 'job_id': job_id})
         response.headers['Content-Type'] = 'application/json; charset=utf-8'
         return response
     except Exception as e:
@@ -194,20 +581,112 @@ def start_process():
         response.headers['Content-Type'] = 'application/json; charset=utf-8'
         return response
 
+@app.route('/job_status/<job_id>')
+@login_required
+def job_status(job_id):
+    job = job_info(job_id) if job_id == current_job_id() else None
+    if job is None:
+        return jsonify({'status': 'error', 'message': 'Задача не найдена'}), 404
+    return jsonify({'job_id': job_id, **job})
+
+@app.route('/job_events/<job_id>')
+@login_required
+def job_events(job_id):
+    """Server-sent events with the job state, sent on every change until the job ends."""
+    if job_id != current_job_id() or job_info(job_id) is None:
+        return jsonify({'status': 'error', 'message': 'Задача не найдена'}), 404
+
+    def stream():
+        last_job = None
+        while True:
+            job = job_info(job_id)
+            if job is None:
+                break
+            if job != last_job:
+                yield f"data: {json.dumps({'job_id': job_id, **job}, ensure_ascii=False)}\n\n"
+                last_job = job
+            if job['status'] in ('done', 'error'):
+                break
+            with jobs_changed:
+                jobs_changed.wait(timeout=JOB_EVENTS_POLL)
+
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def parse_match_items(data):
+    """(names, codes) of the /match request items; raises ValueError on a bad request."""
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        raise ValueError('Ожидается непустой список items')
+    if len(items) > MATCH_API_MAX_ITEMS:
+        raise ValueError(f'Не больше {MATCH_API_MAX_ITEMS} позиций за запрос')
+    names, codes = [], []
+    for item in items:
+        if not isinstance(item, dict):
+            item = {'name': item}
+        name = item.get('name')
+        # Наименования в sklad бывают и числами
+        if not isinstance(name, (str, int, float)) or isinstance(name, bool):
+            raise ValueError('Каждая позиция - наименование или объект с полем name')
+        names.append(name)
+        codes.append(item.get('code'))
+    return names, codes
+
+@app.route('/match', methods=['POST'])
+@login_required
+def match_items():
+    """Best reestr match of a batch of item names, without an Excel round trip.
+
+    Request: {"items": ["name", {"name": "...", "code": "..."}, ...]}. The
+    names are matched against the reestr.xlsx of the session's workspace,
+    kept loaded in resident_reestr, with the rules of the sklad processing
+    (transform_data.match_item_names). Codes are returned with their items
+    as the sklad код is in the result; the reestr has no codes to match.
+    """
+    try:
+        names, codes = parse_match_items(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    job_id = current_job_id()
+    reestr_file = workspace_file(job_id, 'reestr.xlsx') if job_id else None
+    if reestr_file is None or not os.path.exists(reestr_file):
+        return jsonify({'status': 'error', 'message': 'Файл reestr.xlsx не найден'}), 404
+
+    try:
+        import transform_data
+        snapshot = resident_reestr.get(reestr_file)
+        matches = transform_data.match_item_names(names, snapshot)
+    except Exception as e:
+        logger.error(f"Error matching items: {str(e)}")
+        return jsonify({'status': 'error', 'message': f'Ошибка сопоставления: {str(e)}'}), 500
+    logger.info(f"Matched {len(names)} items against reestr {snapshot.cache_key}")
+    return jsonify({
+        'status': 'success',
+        'matches': [{'name': name, 'code': code, **match} for name, code, match in zip(names, codes, matches)],
+    })
+
 @app.route('/download')
 @login_required
 def download_file():
     try:
-        logger.info(f"Download request received. Checking file: {RESULT_FILE}")
+        job_id = current_job_id()
+        if job_id is None:
+            logger.warning("Download request without a workspace")
+            return jsonify({'status': 'error', 'message': 'File not found'})
+        result_file = workspace_file(job_id, 'exit.xlsx')
+        logger.info(f"Download request received. Checking file: {result_file}")
         
-        if os.path.exists(RESULT_FILE):
+        if os.path.exists(result_file):
             # Проверяем размер файла
-            file_size = os.path.getsize(RESULT_FILE)
+            file_size = os.path.getsize(result_file)
             logger.info(f"File exists, size: {file_size} bytes")
+            FILE_BYTES.observe(file_size, endpoint='/download', file='exit')
             
             # Добавим заголовки для предотвращения кэширования
             response = send_file(
-                RESULT_FILE,
+                result_file,
                 as_attachment=True,
                 download_name='result.xlsx',
                 mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
@@ -219,10 +698,10 @@ def download_file():
             logger.info("File sent successfully")
             return response
         else:
-            logger.warning(f"File not found: {RESULT_FILE}")
+            logger.warning(f"File not found: {result_file}")
             # Проверим, какие файлы есть в директории
             try:
-                files_in_dir = os.listdir(WORKING_DIR)
+                files_in_dir = os.listdir(workspace_dir(job_id))
                 logger.info(f"Files in working directory: {files_in_dir}")
             except Exception as dir_error:
                 logger.error(f"Error listing directory: {dir_error}")
@@ -237,10 +716,10 @@ def download_file():
 def clear_files():
     try:
         logger.info("Clear files request received")
-        files = ['sklad.xlsx', 'reestr.xlsx', 'exit.xlsx']
+        job_id = current_job_id()
         cleared = []
-        for file in files:
-            file_path = os.path.join(WORKING_DIR, file)
+        for file in WORKSPACE_FILES if job_id else []:
+            file_path = workspace_file(job_id, file)
             if os.path.exists(file_path):
                 try:
                     os.remove(file_path)
@@ -248,6 +727,10 @@ def clear_files():
                     logger.info(f"Removed file: {file}")
                 except Exception as e:
                     logger.error(f"Error removing {file}: {str(e)}")
+        if job_id:
+            # Следующая загрузка начнёт новую задачу
+            remove_workspace_if_empty(job_id)
+            session.pop('job_id', None)
         
         result = {
             'status': 'success', 
@@ -263,14 +746,17 @@ def clear_files():
 @login_required
 def check_files():
     try:
-        exit_exists = os.path.exists(RESULT_FILE)
-        sklad_exists = os.path.exists(SKLAD_FILE)
-        reestr_exists = os.path.exists(REESTR_FILE)
+        job_id = current_job_id()
+        paths = {name: workspace_file(job_id, f'{name}.xlsx') if job_id else None
+                 for name in ('exit', 'sklad', 'reestr')}
+        exit_exists = bool(paths['exit']) and os.path.exists(paths['exit'])
+        sklad_exists = bool(paths['sklad']) and os.path.exists(paths['sklad'])
+        reestr_exists = bool(paths['reestr']) and os.path.exists(paths['reestr'])
         
         # Дополнительная информация о файлах
         file_info = {}
-        for file_name, file_path in [('exit', RESULT_FILE), ('sklad', SKLAD_FILE), ('reestr', REESTR_FILE)]:
-            if os.path.exists(file_path):
+        for file_name, file_path in paths.items():
+            if file_path and os.path.exists(file_path):
                 try:
                     stat = os.stat(file_path)
                     file_info[f'{file_name}_size'] = stat.st_size
@@ -285,7 +771,8 @@ def check_files():
             'exit_exists': exit_exists,
             'sklad_exists': sklad_exists,
             'reestr_exists': reestr_exists,
-            'working_dir': WORKING_DIR,
+            'job_id': job_id,
+            'working_dir': workspace_dir(job_id) if job_id else None,
             **file_info
         }
         
@@ -309,18 +796,94 @@ def check_files():
         error_response.headers['Content-Type'] = 'application/json; charset=utf-8'
         return error_response
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Histograms of the app and of the transform stages in the Prometheus text format.
+
+    Без авторизации, чтобы Prometheus мог забирать метрики: в них только
+    время и размеры файлов.
+    """
+    import transform_data  # noqa: F401  регистрирует transform_stage_seconds
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+def _decode_log_lines(data):
+    return [line.decode('utf-8', errors='replace') for line in data.splitlines(keepends=True)]
+
+def log_cursor(stat, offset):
+    """Cursor of /get_logs: the log file (inode) and the offset read up to."""
+    return f"{stat.st_ino}:{offset}"
+
+def read_log_tail(log_file, count):
+    """Last count complete lines of log_file and the cursor after them.
+
+    Reads LOG_BLOCK_SIZE blocks backward from the end of the file until
+    they hold count complete lines, so the cost does not depend on the
+    file size.
+    """
+    with open(log_file, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        position = stat.st_size
+        data = b''
+        while position > 0 and data.count(b'\n') <= count:
+            block_size = min(LOG_BLOCK_SIZE, position)
+            position -= block_size
+            f.seek(position)
+            data = f.read(block_size) + data
+    # Незавершённую последнюю строку отдадим при следующем чтении
+    end = data.rfind(b'\n') + 1
+    complete = data[:end]
+    if position > 0:
+        # Первая строка блока может быть обрезана
+        complete = complete[complete.find(b'\n') + 1:]
+    lines = _decode_log_lines(complete)[-count:] if count > 0 else []
+    return lines, log_cursor(stat, position + end)
+
+def read_log_since(log_file, cursor):
+    """Complete lines written to log_file after cursor and the new cursor.
+
+    Returns None when the cursor does not belong to the current log file
+    (it was rotated) or is malformed. At most LOG_READ_MAX_BYTES are read;
+    a longer line is returned in parts.
+    """
+    try:
+        inode, offset = (int(part) for part in cursor.split(':'))
+    except ValueError:
+        return None
+    with open(log_file, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_ino != inode or not 0 <= offset <= stat.st_size:
+            return None
+        f.seek(offset)
+        data = f.read(LOG_READ_MAX_BYTES)
+    end = data.rfind(b'\n') + 1
+    if not end and len(data) == LOG_READ_MAX_BYTES:
+        # Строка длиннее LOG_READ_MAX_BYTES: отдаём её начало, иначе курсор
+        # не сдвинется; последний, возможно обрезанный, символ UTF-8 - в следующий раз
+        end = len(data)
+        while end > 1 and data[end - 1] & 0xC0 == 0x80:
+            end -= 1
+        if data[end - 1] >= 0xC0:
+            end -= 1
+        end = end or len(data)
+    return _decode_log_lines(data[:end]), log_cursor(stat, offset + end)
+
 @app.route('/get_logs')
 @login_required
 def get_logs():
-    """Получить последние строки из лога для отладки"""
+    """Получить последние строки из лога для отладки
+
+    С параметром cursor (из прошлого ответа) возвращает только новые строки.
+    """
     try:
-        log_file = os.path.join(WORKING_DIR, 'app.log')
-        if os.path.exists(log_file):
-            with open(log_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                # Возвращаем последние 50 строк
-                recent_lines = lines[-50:] if len(lines) > 50 else lines
-                return jsonify({'logs': recent_lines})
+        if os.path.exists(LOG_FILE):
+            cursor = request.args.get('cursor')
+            result = read_log_since(LOG_FILE, cursor) if cursor else None
+            if result is None:
+                # Первый запрос или лог ротирован: последние строки
+                lines = request.args.get('lines', LOG_TAIL_LINES, type=int)
+                result = read_log_tail(LOG_FILE, max(0, min(lines, LOG_TAIL_MAX_LINES)))
+            lines, cursor = result
+            return jsonify({'logs': lines, 'cursor': cursor})
         else:
             return jsonify({'logs': ['Файл логов не найден']})
     except Exception as e:
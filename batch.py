@@ -0,0 +1,219 @@
+"""Reconcile many sklad files against one reestr without the web UI.
+
+The reestr is loaded (through the parsed-reestr cache) and indexed once,
+then the sklad files are processed in parallel and every input gets its own
+result workbook, <name>_result.xlsx next to it or in --output-dir (below the
+same subdirectory as the input). A summary of the match rates is printed at
+the end.
+
+    python batch.py reestr.xlsx exports/ --jobs 4
+    python batch.py reestr.xlsx "exports/*.xlsx" --output-dir results
+"""
+import argparse
+import glob
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import transform_data
+
+RESULT_SUFFIX = '_result'
+
+# Reestr and its index in a worker process, set by fork or by _init_worker
+_reestr_df = None
+_reestr_index = None
+
+def _init_worker(reestr_df, reestr_index, log_queue=None):
+    global _reestr_df, _reestr_index
+    _reestr_df = reestr_df
+    _reestr_index = reestr_index
+    if log_queue is not None:
+        transform_data.log_to_queue(log_queue)
+
+def find_sklad_files(sources, exclude=()):
+    """The .xlsx files of the given files, directories and glob patterns.
+
+    Result workbooks (RESULT_SUFFIX), Excel lock files and the paths in
+    exclude are skipped; every file is listed once, in order.
+    """
+    excluded = {os.path.abspath(path) for path in exclude}
+    files = []
+    seen = set()
+    for source in sources:
+        if os.path.isdir(source):
+            paths = sorted(glob.glob(os.path.join(source, '*.xlsx')))
+        elif glob.has_magic(source):
+            paths = sorted(glob.glob(source))
+        else:
+            paths = [source]
+        for path in paths:
+            name = os.path.basename(path)
+            stem = os.path.splitext(name)[0]
+            if name.startswith('~$') or stem.endswith(RESULT_SUFFIX) or os.path.abspath(path) in excluded:
+                continue
+            if os.path.abspath(path) not in seen:
+                seen.add(os.path.abspath(path))
+                files.append(path)
+    return files
+
+def common_dir(sklad_files):
+    """Deepest directory containing all sklad_files."""
+    return os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in sklad_files])
+
+def file_label(sklad_file, base_dir):
+    """sklad_file relative to base_dir (see common_dir), as shown in the summary."""
+    return os.path.relpath(os.path.abspath(sklad_file), base_dir)
+
+def result_paths(sklad_files, output_dir=None):
+    """Result workbook of every sklad file: <name>_result.xlsx in output_dir or next to it.
+
+    In output_dir the results keep the directories of the inputs below
+    their common_dir, so inputs with the same name do not overwrite each
+    other. Raises ValueError if two inputs would still share a result.
+    """
+    base_dir = common_dir(sklad_files) if sklad_files else None
+    paths, owners = [], {}
+    for sklad_file in sklad_files:
+        directory = os.path.dirname(sklad_file)
+        if output_dir:
+            directory = os.path.join(output_dir, os.path.dirname(file_label(sklad_file, base_dir)))
+        stem = os.path.splitext(os.path.basename(sklad_file))[0]
+        path = os.path.join(directory, f"{stem}{RESULT_SUFFIX}.xlsx")
+        owner = owners.setdefault(os.path.normcase(os.path.abspath(path)), sklad_file)
+        if owner != sklad_file:
+            raise ValueError(f"{owner} and {sklad_file} would both be written to {path}")
+        paths.append(path)
+    return paths
+
+def process_file(sklad_file, result_file, engine=None):
+    """Match one sklad file against the worker's reestr and write its result.
+
+    Returns the transform_data.job_summary of the file.
+    """
+    started = time.monotonic()
+    transform_data.stage_timings().clear()
+    with transform_data.timed_stage('load'):
+        sklad_df = transform_data.load_sklad_file(sklad_file)
+    # Сохранённые совпадения хранятся для одного sklad на реестр, файлы
+    # пакета затирали бы их друг у друга
+    result_df = transform_data.create_result_dataframe(sklad_df, _reestr_df, engine=engine,
+                                                       reestr_index=_reestr_index, incremental=False)
+    with transform_data.timed_stage('styling'):
+        styles = transform_data.get_excel_styles(sklad_file)
+    transform_data.apply_excel_formatting(result_df, result_file, styles)
+    transform_data.record_stage('total', time.monotonic() - started)
+    return transform_data.job_summary(sklad_df, _reestr_df, result_df, transform_data.stage_timings())
+
+def run_batch(reestr_file, sklad_files, output_dir=None, jobs=1):
+    """Process sklad_files against reestr_file on up to jobs processes.
+
+    Returns (sklad file, result file, summary, error) per input in the order
+    of sklad_files; summary is None and error the message for failed files.
+    """
+    engine = transform_data.MATCH_ENGINE
+    jobs = max(1, min(jobs, len(sklad_files)))
+    if engine == 'parallel' and jobs > 1:
+        # Файлы и так обрабатываются параллельно
+        engine = 'index'
+
+    tasks = list(zip(sklad_files, result_paths(sklad_files, output_dir)))
+    reestr_df = transform_data.load_reestr(reestr_file)
+    reestr_index = (transform_data.build_reestr_index(reestr_df)
+                    if engine in ('index', 'parallel', 'sparse') else None)
+
+    if output_dir:
+        for result_dir in {os.path.dirname(result_file) for _, result_file in tasks}:
+            os.makedirs(result_dir, exist_ok=True)
+    results = {}
+
+    if jobs == 1:
+        _init_worker(reestr_df, reestr_index)
+        for sklad_file, result_file in tasks:
+            try:
+                results[sklad_file] = (process_file(sklad_file, result_file, engine), None)
+            except Exception as e:
+                results[sklad_file] = (None, str(e))
+            report_file(sklad_file, *results[sklad_file])
+    else:
+        if 'fork' in multiprocessing.get_all_start_methods():
+            # Процессы получают реестр и индекс при fork без копирования
+            context = multiprocessing.get_context('fork')
+            _init_worker(reestr_df, reestr_index)
+            log_queue = context.Queue()
+            initializer, initargs = transform_data.log_to_queue, (log_queue,)
+        else:
+            context = multiprocessing.get_context()
+            log_queue = context.Queue()
+            initializer, initargs = _init_worker, (reestr_df, reestr_index, log_queue)
+        # app.log пишет только этот процесс, записи процессов идут через очередь
+        log_listener = transform_data.start_log_listener(log_queue)
+        try:
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                                     initializer=initializer, initargs=initargs) as executor:
+                futures = {executor.submit(process_file, sklad_file, result_file, engine): sklad_file
+                           for sklad_file, result_file in tasks}
+                for future in as_completed(futures):
+                    sklad_file = futures[future]
+                    try:
+                        results[sklad_file] = (future.result(), None)
+                    except Exception as e:
+                        results[sklad_file] = (None, str(e))
+                    report_file(sklad_file, *results[sklad_file])
+        finally:
+            log_listener.stop()
+    _init_worker(None, None)
+    return [(sklad_file, result_file, *results[sklad_file]) for sklad_file, result_file in tasks]
+
+def report_file(sklad_file, summary, error):
+    if error is not None:
+        print(f"FAILED {sklad_file}: {error}", flush=True)
+    else:
+        print(f"done   {sklad_file} ({summary['timings'].get('total', 0):.1f}s)", flush=True)
+
+def match_rate(matched, rows):
+    return f"{matched / rows * 100:.2f}%" if rows else "-"
+
+def print_summary(results):
+    """Table of rows, matched rows and match rate per file, with the totals."""
+    base_dir = common_dir([sklad_file for sklad_file, *_ in results])
+    labels = [file_label(sklad_file, base_dir) for sklad_file, *_ in results]
+    width = max([len(label) for label in labels] + [len('Total')])
+    print(f"\n{'File':<{width}}  {'Rows':>8}  {'Matched':>8}  {'Rate':>8}  {'Level 2':>8}  {'Level 1':>8}")
+    total_rows = total_matched = 0
+    for name, (sklad_file, result_file, summary, error) in zip(labels, results):
+        if summary is None:
+            print(f"{name:<{width}}  failed: {error}")
+            continue
+        rows, matched = summary['rows']['sklad'], summary['rows']['matched']
+        levels = summary['match_levels']
+        total_rows += rows
+        total_matched += matched
+        print(f"{name:<{width}}  {rows:>8}  {matched:>8}  {match_rate(matched, rows):>8}  "
+              f"{levels['2']:>8}  {levels['1']:>8}")
+    print(f"{'Total':<{width}}  {total_rows:>8}  {total_matched:>8}  {match_rate(total_matched, total_rows):>8}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('reestr', help='reestr workbook')
+    parser.add_argument('sklad', nargs='+', help='sklad workbooks, directories of them or glob patterns')
+    parser.add_argument('--output-dir', help='directory for the results (default: next to each sklad file)')
+    parser.add_argument('--jobs', '-j', type=int, default=os.cpu_count() or 1,
+                        help='sklad files processed in parallel (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    sklad_files = find_sklad_files(args.sklad, exclude=[args.reestr])
+    if not sklad_files:
+        parser.error('no sklad .xlsx files found')
+    try:
+        result_paths(sklad_files, args.output_dir)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"Reconciling {len(sklad_files)} sklad files against {args.reestr} on {args.jobs} jobs", flush=True)
+    results = run_batch(args.reestr, sklad_files, args.output_dir, args.jobs)
+    print_summary(results)
+    return 1 if any(error is not None for *_, error in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
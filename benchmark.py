@@ -0,0 +1,322 @@
+"""Benchmark of transform_data on synthetic sklad and reestr workbooks.
+
+Generates workbooks in the layouts the loader expects (the reestr columns
+at REESTR_COLUMN_POSITIONS, the sklad with its Russian headers), runs
+load_excel_files, create_result_dataframe and apply_excel_formatting on
+them and records wall time, rows/sec and RSS of every stage. The workbooks
+of a size are generated in one fresh process and the stages run in another;
+the RSS of a stage is sampled while it runs (peak_rss_mb) and compared with
+its value when the stage started (rss_growth_mb). The results are saved as
+JSON; --baseline compares them with an earlier file.
+
+    python benchmark.py --rows 1000 10000 100000 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import multiprocessing
+
+import openpyxl
+import pandas as pd
+
+try:
+    import psutil
+except ImportError:  # без psutil RSS читается из /proc (только Linux)
+    psutil = None
+
+DEFAULT_ROWS = [1000, 10000, 100000]
+# Seconds between two RSS samples of a running stage
+RSS_SAMPLE_INTERVAL = 0.01
+# Share of the distinct sklad names per intended match stage (see
+# transform_data.count_match_stages)
+DEFAULT_SIMILARITY = {'exact': 0.3, 'substring': 0.2, 'jaccard': 0.2, 'partial': 0.1, 'none': 0.2}
+
+SYLLABLES = ['ба', 'ве', 'ги', 'до', 'ка', 'ло', 'ми', 'но', 'па', 'ре', 'си', 'ту', 'фе', 'ха', 'че', 'шу']
+SIZES = ['М6', 'М8', 'М10', 'М12', '3х1,5', '3х2,5', '5х4', 'ДУ15', 'ДУ20', 'ДУ25', '(оц)', '1/2"']
+
+def make_vocabulary(rng, size):
+    """size distinct pseudo-words plus the size tokens."""
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words) + SIZES
+
+def make_reestr_names(rng, count, vocabulary):
+    """Reestr names of 3-6 words, starting with a capital like in invoices."""
+    names = []
+    for _ in range(count):
+        words = [rng.choice(vocabulary) for _ in range(rng.randint(3, 6))]
+        words[0] = words[0].capitalize()
+        names.append(' '.join(words))
+    return names
+
+def _similar_name(rng, name, stage, vocabulary, other_words):
+    """A name intended to match name at the given stage of count_match_stages."""
+    words = name.split()
+    if stage == 'exact':
+        return name.upper() if rng.random() < 0.5 else name
+    if stage == 'substring':
+        return f"{name} {rng.choice(SIZES)}"
+    if stage == 'jaccard':
+        # Те же слова в другом порядке: Jaccard 1, но не подстрока
+        shuffled = words[::-1] if len(set(words)) > 1 else words + [rng.choice(vocabulary)]
+        return ' '.join(shuffled)
+    if stage == 'partial':
+        # Оставляем kept слов из count, чтобы 0.4 < Jaccard <= 0.6
+        count = len(words)
+        kept = next((kept for kept in range(count - 1, 0, -1) if kept / (2 * count - kept) <= 0.6), 1)
+        return ' '.join(words[:kept][::-1] + [rng.choice(other_words) for _ in range(count - kept)])
+    return ' '.join(rng.choice(other_words) for _ in range(len(words)))
+
+def make_sklad_names(rng, count, reestr_names, duplicate_ratio, similarity, vocabulary, other_words):
+    """Sklad item names, duplicate_ratio of them repeating an earlier name.
+
+    The distinct names are derived from random reestr names, the stage each
+    should match at is drawn from the similarity distribution.
+    """
+    distinct_count = max(1, round(count * (1 - duplicate_ratio)))
+    stages = list(similarity)
+    weights = [similarity[stage] for stage in stages]
+    distinct = [_similar_name(rng, rng.choice(reestr_names), rng.choices(stages, weights)[0],
+                              vocabulary, other_words)
+                for _ in range(distinct_count)]
+    names = distinct + [rng.choice(distinct) for _ in range(count - distinct_count)]
+    rng.shuffle(names)
+    return names
+
+def write_sklad(path, names, rng):
+    """Sklad workbook with the Russian headers of SKLAD_DIRECT_COLUMNS."""
+    import transform_data
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(list(transform_data.SKLAD_DIRECT_COLUMNS))
+    start = datetime(2024, 1, 1)
+    payers = ['ООО "Ромашка"', 'АО "Лютик"', 'ИП Васильков']
+    for row, name in enumerate(names):
+        ws.append([100000 + row % 5000, name, 'шт', rng.choice(payers), f'ПМ-{row:06d}',
+                   start + timedelta(hours=row), rng.randint(1, 50)])
+    wb.save(path)
+
+def write_reestr(path, names, rng, width=24):
+    """Reestr workbook with the columns at REESTR_COLUMN_POSITIONS."""
+    import transform_data
+    header = [f'Колонка {pos + 1}' for pos in range(width)]
+    for pos, column in transform_data.REESTR_COLUMN_POSITIONS.items():
+        header[pos] = column
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(header)
+    start = datetime(2023, 1, 1)
+    suppliers = ['ООО "Снабжение"', 'АО "Металлторг"', 'ООО "Электрокомплект"']
+    for row, name in enumerate(names):
+        values = [f'v{pos}-{row}' for pos in range(width)]
+        values[4] = rng.choice(suppliers)
+        values[5] = name
+        values[6] = f'СЧ-{row:06d}'
+        values[8] = start + timedelta(days=row % 700)
+        values[9] = f'пп {row}'
+        values[17] = rng.randint(1, 100)
+        values[21] = round(rng.uniform(1, 10000), 2)
+        ws.append(values)
+    wb.save(path)
+
+def generate(directory, rows, reestr_rows, duplicate_ratio, similarity, seed, vocabulary_size):
+    """Write sklad.xlsx and reestr.xlsx to directory; return their paths."""
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(rng, vocabulary_size)
+    other_words = make_vocabulary(random.Random(seed + 1), vocabulary_size)
+    other_words = [word.upper() for word in other_words if word not in vocabulary]
+    reestr_names = make_reestr_names(rng, reestr_rows, vocabulary)
+    sklad_names = make_sklad_names(rng, rows, reestr_names, duplicate_ratio, similarity,
+                                   vocabulary, other_words)
+    sklad_file = os.path.join(directory, 'sklad.xlsx')
+    reestr_file = os.path.join(directory, 'reestr.xlsx')
+    write_sklad(sklad_file, sklad_names, rng)
+    write_reestr(reestr_file, reestr_names, rng)
+    return sklad_file, reestr_file
+
+def rss_mb():
+    """Current resident set size of this process in MiB (None where it cannot be read)."""
+    if psutil is not None:
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+
+class RssSampler:
+    """RSS of this process while a with block runs.
+
+    A thread samples rss_mb every RSS_SAMPLE_INTERVAL seconds; start and
+    peak are the RSS at the start and the highest sample (None where RSS
+    cannot be read).
+    """
+
+    def __init__(self, interval=RSS_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.start = self.peak = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        rss = rss_mb()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self.start = rss_mb()
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+def measure(stages, stage, rows, func, *args, **kwargs):
+    """Run func, store its time, rows/sec and RSS in stages[stage] and return its value."""
+    started = time.perf_counter()
+    with RssSampler() as sampler:
+        value = func(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    stages[stage] = {
+        'seconds': round(seconds, 3),
+        'rows': rows,
+        'rows_per_sec': round(rows / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mb': round(sampler.peak, 1) if sampler.peak is not None else None,
+        'rss_growth_mb': round(sampler.peak - sampler.start, 1) if sampler.start is not None else None,
+    }
+    return value
+
+def generate_size(params, directory):
+    """Generate the workbooks of one size in directory; (sklad file, reestr file, stages)."""
+    stages = {}
+    sklad_file, reestr_file = measure(
+        stages, 'generate', params['rows'] + params['reestr_rows'], generate, directory,
+        params['rows'], params['reestr_rows'], params['duplicate_ratio'], params['similarity'],
+        params['seed'], params['vocabulary_size'])
+    return sklad_file, reestr_file, stages
+
+def run_size(params, sklad_file, reestr_file):
+    """Time the stages on the workbooks of one size."""
+    import transform_data
+    # Кэши не должны влиять на замер
+    transform_data.REESTR_CACHE_DIR = ''
+    transform_data.MATCH_INCREMENTAL = False
+
+    stages = {}
+    rows, reestr_rows = params['rows'], params['reestr_rows']
+    sklad_df, reestr_df = measure(stages, 'load', rows + reestr_rows, transform_data.load_excel_files,
+                                  sklad_file, reestr_file)
+    result_df = measure(stages, 'match', rows, transform_data.create_result_dataframe,
+                        sklad_df, reestr_df, engine=params['engine'])
+    styles = measure(stages, 'styles', rows, transform_data.get_excel_styles, sklad_file)
+    measure(stages, 'write', rows, transform_data.apply_excel_formatting,
+            result_df, os.path.join(os.path.dirname(sklad_file), 'exit.xlsx'), styles)
+    summary = transform_data.job_summary(sklad_df, reestr_df, result_df, {})
+    return {'rows': rows, 'reestr_rows': reestr_rows, 'stages': stages,
+            'match_levels': summary['match_levels'], 'match_stages': summary['match_stages']}
+
+def run_in_process(func, *args):
+    """func(*args) in a fresh process, so its RSS does not include earlier work."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(func, *args).result()
+
+def parse_similarity(text):
+    """'exact=0.3,none=0.7' -> {'exact': 0.3, 'none': 0.7}."""
+    similarity = {}
+    for part in text.split(','):
+        stage, _, share = part.partition('=')
+        if stage.strip() not in DEFAULT_SIMILARITY:
+            raise argparse.ArgumentTypeError(f"unknown stage {stage.strip()!r}, expected one of "
+                                             f"{', '.join(DEFAULT_SIMILARITY)}")
+        similarity[stage.strip()] = float(share)
+    return similarity
+
+def compare_results(results, baseline):
+    """Print the change of every stage's time against a baseline result file."""
+    baseline_runs = {(run['rows'], run['reestr_rows']): run for run in baseline['results']}
+    for run in results['results']:
+        old = baseline_runs.get((run['rows'], run['reestr_rows']))
+        if old is None:
+            continue
+        for stage, values in run['stages'].items():
+            old_values = old['stages'].get(stage)
+            if old_values and old_values['seconds']:
+                change = (values['seconds'] / old_values['seconds'] - 1) * 100
+                print(f"{run['rows']:>8} rows {stage:<9} {old_values['seconds']:>9.3f}s -> "
+                      f"{values['seconds']:>9.3f}s ({change:+.1f}%)")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=DEFAULT_ROWS,
+                        help='sklad row counts to run (default: %(default)s)')
+    parser.add_argument('--reestr-rows', type=int,
+                        help='reestr rows for every size (default: the sklad rows)')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.7,
+                        help='share of sklad rows repeating an earlier item name (default: %(default)s)')
+    parser.add_argument('--similarity', type=parse_similarity, default=DEFAULT_SIMILARITY,
+                        help='share of distinct item names per match stage, e.g. '
+                             'exact=0.3,substring=0.2,jaccard=0.2,partial=0.1,none=0.2')
+    parser.add_argument('--vocabulary-size', type=int, default=2000,
+                        help='distinct words in the generated names (default: %(default)s)')
+    parser.add_argument('--engine', help='match engine (default: MATCH_ENGINE)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    parser.add_argument('--baseline', help='earlier JSON results file to compare with')
+    args = parser.parse_args(argv)
+
+    import transform_data
+    runs = []
+    for rows in args.rows:
+        params = {'rows': rows, 'reestr_rows': args.reestr_rows or rows,
+                  'duplicate_ratio': args.duplicate_ratio, 'similarity': args.similarity,
+                  'vocabulary_size': args.vocabulary_size, 'seed': args.seed,
+                  'engine': args.engine or transform_data.MATCH_ENGINE}
+        directory = tempfile.mkdtemp(prefix='benchmark-')
+        try:
+            sklad_file, reestr_file, stages = run_in_process(generate_size, params, directory)
+            run = run_in_process(run_size, params, sklad_file, reestr_file)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+        run['stages'] = {**stages, **run['stages']}
+        runs.append(run)
+        print(f"{rows:>8} rows: " + ", ".join(
+            f"{stage} {values['seconds']:.2f}s" for stage, values in run['stages'].items()))
+
+    results = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'platform': platform.platform(),
+        'settings': transform_data.result_settings(),
+        'params': {'duplicate_ratio': args.duplicate_ratio, 'similarity': args.similarity,
+                   'vocabulary_size': args.vocabulary_size, 'seed': args.seed,
+                   'engine': args.engine or transform_data.MATCH_ENGINE},
+        'results': runs,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            compare_results(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""Histograms kept in process memory and rendered in the Prometheus text format."""
+import bisect
+import threading
+
+# Bucket upper bounds for durations in seconds and for file sizes in bytes
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(11))  # 1 КБ ... 1 ГБ
+
+# Histograms rendered by render_metrics, in the order they were created
+REGISTRY = []
+
+class Histogram:
+    """Prometheus histogram with optional labels.
+
+    observe(value, **labels) counts value in every bucket whose upper bound
+    it does not exceed, as Prometheus' cumulative buckets do.
+    """
+
+    def __init__(self, name, documentation, buckets, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        self._series = {}  # label values -> (bucket counts, sum, count)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[label]) for label in self.labels)
+        with self._lock:
+            counts, total, count = self._series.get(key, ([0] * len(self.buckets), 0.0, 0))
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(counts):
+                counts[position] += 1
+            self._series[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        """Lines of the text exposition format."""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, (list(counts), total, count))
+                            for key, (counts, total, count) in self._series.items())
+        for key, (counts, total, count) in series:
+            labels = [f'{label}="{_escape(value)}"' for label, value in zip(self.labels, key)]
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(labels + [_le(bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(labels + [_le('+Inf')])} {count}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+        return lines
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _le(bound):
+    return f'le="{bound}"'
+
+def _labels(labels):
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+def render_metrics():
+    """All histograms of REGISTRY in the Prometheus text format."""
+    return '\n'.join(line for histogram in REGISTRY for line in histogram.render()) + '\n'
@@ -17,7 +17,8 @@ const CONFIG = {
         DOWNLOAD: '/download',
         CLEAR: '/clear',
         CHECK_FILES: '/check_files',
-        GET_LOGS: '/get_logs'
+        GET_LOGS: '/get_logs',
+        JOB_EVENTS: '/job_events'
     },
     TIMEOUTS: {
         REQUEST: 30000,
@@ -366,7 +367,7 @@ async function startProcess() {
         
         if (data.status === 'success') {
             showMessage(data.message, 'success');
-            startFileCheck(); // Начинаем проверку результата
+            watchJob(data.job_id); // Подписываемся на ход обработки
         } else {
             showMessage(data.message || 'Ошибка запуска процесса', 'error');
         }
@@ -378,43 +379,104 @@ async function startProcess() {
 }
 
 /**
- * Проверка готовности результата
+ * Названия этапов обработки для консоли статуса
  */
-function startFileCheck() {
-    let attempts = 0;
-    const maxAttempts = 60; // 2 минуты максимум
-    
-    const checkInterval = setInterval(async () => {
-        attempts++;
-        
-        try {
-            const data = await makeRequest(CONFIG.ENDPOINTS.CHECK_FILES);
-            
-            if (data.exit_exists) {
-                showMessage('Обработка завершена! Файл готов для скачивания', 'success');
-                await updateFileIndicators();
-                clearInterval(checkInterval);
-                return;
-            }
-            
-            // Показываем прогресс каждые 10 попыток
-            if (attempts % 10 === 0) {
-                showMessage(`Обработка продолжается... (${attempts * 2} сек)`, 'info');
-            }
-            
-            if (attempts >= maxAttempts) {
-                showMessage('Превышено время ожидания результата. Проверьте логи.', 'error');
-                clearInterval(checkInterval);
-            }
-            
-        } catch (error) {
-            console.error('Ошибка проверки файлов:', error);
-            if (attempts >= 5) { // Прекращаем после 5 неудачных попыток
-                showMessage('Ошибка при проверке статуса обработки', 'error');
-                clearInterval(checkInterval);
+const JOB_STAGES = {
+    load: 'Загрузка файлов',
+    match: 'Сопоставление строк',
+    write: 'Запись результата'
+};
+
+/**
+ * Названия этапов в разбивке времени обработки
+ */
+const TIMING_STAGES = {
+    load: 'загрузка',
+    header_detection: 'поиск заголовков',
+    matching: 'сопоставление',
+    assembly: 'сборка результата',
+    styling: 'оформление',
+    save: 'сохранение',
+    total: 'всего'
+};
+
+/**
+ * Текст разбивки времени обработки по этапам
+ */
+function formatTimings(timings) {
+    return Object.entries(timings)
+        .map(([stage, seconds]) => `${TIMING_STAGES[stage] || stage} ${seconds.toFixed(2)} сек`)
+        .join(', ');
+}
+
+/**
+ * Текст сообщения о ходе обработки
+ */
+function formatProgress(progress) {
+    let text = JOB_STAGES[progress.stage] || progress.stage;
+    if (progress.total) {
+        const percent = Math.floor(progress.done * 100 / progress.total);
+        text += `: ${progress.done} из ${progress.total} (${percent}%)`;
+    }
+    if (progress.eta !== null && progress.eta !== undefined && progress.done < progress.total) {
+        text += `, осталось ~${Math.ceil(progress.eta)} сек`;
+    }
+    return text;
+}
+
+/**
+ * Следить за задачей обработки через события сервера
+ */
+function watchJob(jobId) {
+    const source = new EventSource(`${CONFIG.ENDPOINTS.JOB_EVENTS}/${jobId}`);
+    let lastStage = null;
+    let lastStep = -1;
+    let queuedShown = false;
+
+    source.onmessage = async (event) => {
+        const job = JSON.parse(event.data);
+
+        if (job.status === 'done') {
+            source.close();
+            showMessage('Обработка завершена! Файл готов для скачивания', 'success');
+            if (job.timings) {
+                showMessage(`Время этапов: ${formatTimings(job.timings)}`, 'info');
             }
+            await updateFileIndicators();
+            return;
+        }
+
+        if (job.status === 'error') {
+            source.close();
+            showMessage(`Ошибка обработки: ${job.error || 'неизвестная ошибка'}`, 'error');
+            await updateFileIndicators();
+            return;
+        }
+
+        if (job.status === 'queued' && !queuedShown) {
+            queuedShown = true;
+            showMessage('Задача ожидает в очереди...', 'info');
+        }
+
+        const progress = job.progress;
+        if (!progress || progress.stage === 'done') {
+            return;
+        }
+
+        // Показываем смену этапа и каждые 10% внутри этапа
+        const step = progress.total ? Math.floor(progress.done * 10 / progress.total) : 0;
+        if (progress.stage !== lastStage || step > lastStep) {
+            lastStage = progress.stage;
+            lastStep = step;
+            showMessage(formatProgress(progress), 'info');
         }
-    }, 2000);
+    };
+
+    source.onerror = () => {
+        if (source.readyState === EventSource.CLOSED) {
+            showMessage('Потеряно соединение с сервером при отслеживании обработки. Проверьте логи.', 'error');
+        }
+    };
 }
 
 // =============================================================================
@@ -506,14 +568,27 @@ async function clearFiles() {
 // ЛОГИ
 // =============================================================================
 
+// Позиция в логе, до которой строки уже показаны
+let logCursor = null;
+
 /**
- * Показать логи системы
+ * Показать логи системы (при повторном вызове - только новые строки)
  */
 async function showLogs() {
     try {
-        const data = await makeRequest(CONFIG.ENDPOINTS.GET_LOGS);
+        const url = logCursor
+            ? `${CONFIG.ENDPOINTS.GET_LOGS}?cursor=${encodeURIComponent(logCursor)}`
+            : CONFIG.ENDPOINTS.GET_LOGS;
+        const data = await makeRequest(url);
         
         if (data && data.logs) {
+            if (data.cursor) {
+                logCursor = data.cursor;
+            }
+            if (!data.logs.length) {
+                showMessage('Новых строк в логе нет', 'info');
+                return;
+            }
             showMessage('=== ЛОГИ СИСТЕМЫ ===', 'info');
             data.logs.forEach(line => {
                 if (line.trim()) {
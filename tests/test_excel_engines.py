@@ -0,0 +1,75 @@
+"""openpyxl and calamine read the input workbooks to the same frames."""
+from datetime import datetime
+
+import openpyxl
+import pandas as pd
+import pytest
+
+import transform_data
+
+pytest.importorskip("python_calamine")
+
+ENGINES = ('openpyxl', 'calamine')
+# Reestr columns the transform reads, by position (see REESTR_COLUMN_POSITIONS)
+REESTR_POSITIONS = [4, 5, 6, 8, 9, 17, 21]
+
+def write_workbook(path, header, rows):
+    """Workbook with a title row and an empty row above the header row."""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.append(['Отчёт за период'])
+    ws.append([])
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+
+@pytest.fixture
+def reestr_file(tmp_path):
+    header = [f'Колонка {pos + 1}' for pos in range(24)]
+    header[4], header[5], header[6] = 'Компания поставщик', 'Наименование в счёте', 'ID счёта'
+    header[8], header[9] = 'Дата последнего платежа', 'Номера платёжных поручений'
+    header[17], header[21] = 'Кол-во в счёте', 'Цена за ед.'
+    rows = []
+    for number in range(20):
+        row = [f'x{number}'] * 24
+        row[4] = f'ООО Поставщик {number % 3}'
+        row[5] = f'Болт М{number} оцинкованный' if number != 7 else None
+        row[6] = 1000 + number
+        row[8] = datetime(2024, 1, 1 + number)
+        row[9] = f'{number}, {number + 1}' if number % 2 else number
+        row[17] = number * 2.5 if number % 4 else None
+        row[21] = round(number * 10.1, 2)
+        rows.append(row)
+    path = tmp_path / 'reestr.xlsx'
+    write_workbook(path, header, rows)
+    return path
+
+@pytest.fixture
+def sklad_file(tmp_path):
+    header = list(transform_data.SKLAD_DIRECT_COLUMNS.values())
+    rows = []
+    for number in range(20):
+        rows.append([
+            f'00-{number:05d}', f'Болт М{number}', 'шт', 'ООО Склад', f'ПМ-{number}',
+            datetime(2024, 2, 1 + number), number + 0.5 if number % 3 else number,
+        ])
+    path = tmp_path / 'sklad.xlsx'
+    write_workbook(path, header, rows)
+    return path
+
+def read_with_engines(path, expected_columns):
+    return {engine: transform_data.read_excel_with_header(str(path), expected_columns, engine=engine)
+            for engine in ENGINES}
+
+def test_reestr_same_header_row_and_columns(reestr_file):
+    frames = read_with_engines(reestr_file, transform_data.REESTR_EXPECTED)
+    (openpyxl_df, openpyxl_header), (calamine_df, calamine_header) = frames['openpyxl'], frames['calamine']
+    assert openpyxl_header == calamine_header == 2
+    pd.testing.assert_frame_equal(openpyxl_df.iloc[:, REESTR_POSITIONS], calamine_df.iloc[:, REESTR_POSITIONS])
+
+def test_sklad_same_header_row_and_columns(sklad_file):
+    frames = read_with_engines(sklad_file, transform_data.SKLAD_EXPECTED)
+    (openpyxl_df, openpyxl_header), (calamine_df, calamine_header) = frames['openpyxl'], frames['calamine']
+    assert openpyxl_header == calamine_header == 2
+    pd.testing.assert_frame_equal(openpyxl_df, calamine_df)
@@ -0,0 +1,129 @@
+"""The match engines find the same reestr row as the original first-best scan."""
+import random
+
+import pandas as pd
+import pytest
+
+import transform_data
+
+WORDS = ['болт', 'гайка', 'шайба', 'винт', 'м6', 'м8', 'м12', 'м16', 'din', '933', '934', 'оцинк', 'ёрш',
+         'ерш', 'кабель', 'ввг', 'нг', '3х2,5', '3х1,5', 'труба', 'гост', 'сталь', 'медь', 'провод', 'клемма',
+         'муфта', 'реле', 'щит', 'кран', 'шар', 'ду15', 'ду20', 'латунь', 'пвх', 'лента', 'изолента']
+SEPARATORS = [' ', '  ', ', ', '-', '/', ' (', ') ', '.', '"']
+# Пустые имена и имена из одной пунктуации
+REESTR_SPECIAL_NAMES = ['', None, 0, '...', ' - ', '«»']
+# Ещё числовые и однобуквенные: в реестре такое имя входило бы почти в любую
+# позицию склада и забирало бы все совпадения
+SPECIAL_NAMES = REESTR_SPECIAL_NAMES + [12, 933, '12', 'Ё', 'a', ' ']
+
+def join_words(rng, words):
+    name = words[0]
+    for word in words[1:]:
+        name += rng.choice(SEPARATORS) + word
+    return name.upper() if rng.random() < 0.2 else name
+
+def random_name(rng):
+    return join_words(rng, [rng.choice(WORDS) for _ in range(rng.randint(2, 6))])
+
+def random_names(seed, reestr_size=120, item_count=150):
+    """Reestr names and item names, many of them cut out of, extending or sharing words with reestr names."""
+    rng = random.Random(seed)
+    reestr_names = [rng.choice(REESTR_SPECIAL_NAMES) if rng.random() < 0.1 else random_name(rng)
+                    for _ in range(reestr_size)]
+    if seed % 2:
+        # Пробел нормализуется в пустую строку, она входит в любое имя
+        reestr_names.insert(rng.randrange(reestr_size * 3 // 4, reestr_size), ' ')
+    item_names = []
+    for _ in range(item_count):
+        source = str(rng.choice(reestr_names) or '')
+        kind = rng.random()
+        if kind < 0.1:
+            item_names.append(rng.choice(SPECIAL_NAMES))
+        elif kind < 0.25 and source:
+            start = rng.randrange(len(source))
+            item_names.append(source[start:rng.randint(start + 1, len(source))])
+        elif kind < 0.4:
+            item_names.append(f'{source} {random_name(rng)}')
+        elif kind < 0.7 and transform_data.normalize_text(source):
+            words = transform_data.normalize_text(source).split()
+            rng.shuffle(words)
+            words = words[:rng.randint(1, len(words))] + [rng.choice(WORDS) for _ in range(rng.randint(0, 2))]
+            item_names.append(' '.join(words))
+        else:
+            item_names.append(random_name(rng))
+    return reestr_names, item_names
+
+def baseline_matches(item_names, reestr_names):
+    """First reestr row with the highest compare_strings_advanced level per item, as the original loop."""
+    matches = []
+    for item_name in item_names:
+        match = (None, 0)
+        for row_pos, reestr_name in enumerate(reestr_names):
+            level = transform_data.compare_strings_advanced(item_name, reestr_name)
+            if level > match[1]:
+                match = (row_pos, level)
+        matches.append(match)
+    return matches
+
+def normalized_frame(names, column):
+    df = pd.DataFrame({column: names})
+    return transform_data.add_normalized_columns(df, df[column])
+
+def normalized_columns(names):
+    norms, token_sets, _ = transform_data.normalize_names(names)
+    return norms, token_sets
+
+@pytest.fixture(params=range(6))
+def names(request):
+    return random_names(request.param)
+
+def test_index_matches_baseline(names):
+    reestr_names, item_names = names
+    reestr_index = transform_data.ReestrIndex(*normalized_columns(reestr_names))
+    assert transform_data.find_best_matches(reestr_index, *normalized_columns(item_names)) == \
+        baseline_matches(item_names, reestr_names)
+
+def test_index_workers_match_baseline(names, monkeypatch):
+    monkeypatch.setattr(transform_data, 'MATCH_CHUNK_SIZE', 40)
+    reestr_names, item_names = names
+    reestr_index = transform_data.ReestrIndex(*normalized_columns(reestr_names))
+    assert transform_data.find_best_matches(reestr_index, *normalized_columns(item_names), workers=2) == \
+        baseline_matches(item_names, reestr_names)
+
+@pytest.mark.skipif(transform_data.sparse is None, reason="SciPy is not installed")
+def test_sparse_matches_baseline(names, monkeypatch):
+    monkeypatch.setattr(transform_data, 'SPARSE_BLOCK_ROWS', 32)
+    reestr_names, item_names = names
+    reestr_index = transform_data.ReestrIndex(*normalized_columns(reestr_names))
+    assert transform_data.find_best_matches_sparse(reestr_index, *normalized_columns(item_names)) == \
+        baseline_matches(item_names, reestr_names)
+
+def test_scan_matches_baseline(names):
+    reestr_names, item_names = names
+    sklad_df = normalized_frame(item_names, 'предмет')
+    reestr_df = normalized_frame(reestr_names, 'Наименование в счёте')
+    assert transform_data.find_best_matches_scan(sklad_df, reestr_df) == baseline_matches(item_names, reestr_names)
+
+def test_incremental_matches_only_changed_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr(transform_data, 'REESTR_CACHE_DIR', str(tmp_path))
+    reestr_names, item_names = random_names(7)
+    reestr_df = normalized_frame(reestr_names, 'Наименование в счёте')
+    transform_data.store_cached_reestr('reestr-v1', reestr_df)
+    reestr_df.attrs[transform_data.REESTR_VERSION_ATTR] = 'reestr-v1'
+    reestr_index = transform_data.ReestrIndex(*normalized_columns(reestr_names))
+    matched_rows = []
+
+    def match_rows(norms, token_sets):
+        matched_rows.append(len(norms))
+        return transform_data.find_best_matches(reestr_index, norms, token_sets)
+
+    def run(item_names):
+        sklad_df = normalized_frame(item_names, 'предмет')
+        sklad_df['код'] = [f'00-{row_pos:05d}' for row_pos in range(len(sklad_df))]
+        return transform_data.find_matches_incremental(sklad_df, reestr_df, match_rows,
+                                                       transform_data.ProgressReporter())
+
+    assert run(item_names) == baseline_matches(item_names, reestr_names)
+    item_names[3] = 'болт м12 din 933 новый'
+    assert run(item_names) == baseline_matches(item_names, reestr_names)
+    assert matched_rows == [len(item_names), 1]
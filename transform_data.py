@@ -1,23 +1,160 @@
 import pandas as pd
 import os
 from fuzzywuzzy import fuzz
-from datetime import datetime
+from datetime import datetime, date, time
 import openpyxl
-from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
+from openpyxl.styles import Font, PatternFill, Border, Side, Alignment, NamedStyle
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
 import logging
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 import re
 import subprocess
+import bisect
+import heapq
+import json
+import shutil
+import hashlib
+import gc
+import itertools
+import multiprocessing
+import threading
+import uuid
+from contextlib import contextmanager
+from time import monotonic
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from pandas.io.parsers import TextParser
+
+import metrics
+
+try:
+    from scipy import sparse
+except ImportError:  # SciPy нужен только для MATCH_ENGINE='sparse'
+    sparse = None
 
 # Configuration
 WORKING_DIR = os.path.dirname(os.path.abspath(__file__))  # Текущая директория скрипта
 
+# Matcher used by create_result_dataframe: 'index' (ReestrIndex), 'parallel'
+# (ReestrIndex in a process pool), 'sparse' (Jaccard via SciPy sparse
+# matrices) or 'scan' (full reestr scan)
+MATCH_ENGINE = os.environ.get('MATCH_ENGINE', 'index')
+# Worker processes and sklad rows per task for the 'parallel' engine
+MATCH_WORKERS = int(os.environ.get('MATCH_WORKERS', os.cpu_count() or 1))
+MATCH_CHUNK_SIZE = int(os.environ.get('MATCH_CHUNK_SIZE', 1000))
+# Sklad rows per sparse matrix product for the 'sparse' engine
+SPARSE_BLOCK_ROWS = int(os.environ.get('SPARSE_BLOCK_ROWS', 500))
+# Input loader: 'pandas' (pd.read_excel) or 'stream' (only the mapped columns, row by row)
+EXCEL_LOADER = os.environ.get('EXCEL_LOADER', 'pandas')
+# pd.read_excel engine of the 'pandas' loader: 'calamine', 'openpyxl' or 'auto'
+# (calamine when python-calamine is installed, openpyxl otherwise)
+EXCEL_ENGINE = os.environ.get('EXCEL_ENGINE', 'auto')
+# Parsed-reestr cache: one directory of .npy files per reestr file hash ('' to
+# disable) and the number of reestr versions kept there
+REESTR_CACHE_DIR = os.environ.get('REESTR_CACHE_DIR', os.path.join(WORKING_DIR, 'reestr_cache'))
+REESTR_CACHE_ENTRIES = int(os.environ.get('REESTR_CACHE_ENTRIES', 8))
+# Most bytes the parsed reestrs take in REESTR_CACHE_DIR; least recently used
+# ones are evicted above it
+REESTR_CACHE_MAX_BYTES = int(os.environ.get('REESTR_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+# Reuse the matches of sklad rows already matched against the same reestr
+# (stored next to the parsed reestr) and match only new or changed rows
+MATCH_INCREMENTAL = os.environ.get('MATCH_INCREMENTAL', '1') == '1'
+# Normalized item names whose best match is kept for repeated sklad rows
+# (least recently used ones are dropped, 0 disables the memo)
+MATCH_MEMO_SIZE = int(os.environ.get('MATCH_MEMO_SIZE', 100000))
+# app.log is rotated to app.log.1 ... app.log.<LOG_BACKUP_COUNT> at LOG_MAX_BYTES
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+# Verbose debug: log at DEBUG level, with the sample data and column mappings
+# of the inputs and every reestr comparison of the sklad row with the index
+# label DEBUG_TRACE_ROW
+VERBOSE_DEBUG = os.environ.get('VERBOSE_DEBUG', '0') == '1'
+DEBUG_TRACE_ROW = int(os.environ.get('DEBUG_TRACE_ROW', 0))
+# Minimum seconds between two row-count progress reports of a stage
+PROGRESS_INTERVAL = float(os.environ.get('PROGRESS_INTERVAL', 0.5))
+
 # Configure logging
 logging.basicConfig(
-    filename=os.path.join(WORKING_DIR, 'app.log'),
+    handlers=[RotatingFileHandler(os.path.join(WORKING_DIR, 'app.log'), maxBytes=LOG_MAX_BYTES,
+                                  backupCount=LOG_BACKUP_COUNT, encoding='utf-8')],
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if VERBOSE_DEBUG else logging.INFO)
+
+def log_to_queue(queue):
+    """Send the log records of this worker process to queue instead of app.log.
+
+    Only one process may write and rotate app.log: a worker forked from it
+    would rotate its own copy of the handler and keep writing to the renamed
+    file. The process that owns the log writes the queued records, see
+    start_log_listener.
+    """
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(QueueHandler(queue))
+
+def start_log_listener(queue):
+    """Started QueueListener writing the records of log_to_queue workers to this process's handlers."""
+    listener = QueueListener(queue, *logging.getLogger().handlers, respect_handler_level=True)
+    listener.start()
+    return listener
+
+class LazyLog:
+    """Log argument computed only when the record is emitted.
+
+    logger.debug("%s", LazyLog(df.to_string)) calls df.to_string() only
+    when DEBUG is enabled.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+# Seconds spent in the stages of a run: 'load', 'header_detection', 'matching',
+# 'assembly', 'styling', 'save' and 'total'; one observation per stage and job
+# (see observe_stage_timings)
+STAGE_SECONDS = metrics.Histogram('transform_stage_seconds', 'Seconds spent in a transform_data stage',
+                                  metrics.DURATION_BUCKETS, labels=('stage',))
+# Seconds per stage of the current run of each thread, see stage_timings
+_stage_local = threading.local()
+
+def stage_timings():
+    """Seconds per stage of the current run in this thread, reset by main().
+
+    Runs in other threads of the process (an app job next to a reestr
+    being loaded) keep their own timings.
+    """
+    timings = getattr(_stage_local, 'timings', None)
+    if timings is None:
+        timings = _stage_local.timings = {}
+    return timings
+
+def record_stage(stage, seconds):
+    """Add seconds spent in stage to stage_timings."""
+    timings = stage_timings()
+    timings[stage] = timings.get(stage, 0) + seconds
+
+def observe_stage_timings(timings):
+    """Observe the stage timings of one finished job in STAGE_SECONDS."""
+    for stage, seconds in timings.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+@contextmanager
+def timed_stage(stage):
+    """record_stage the time spent in the with block."""
+    started = monotonic()
+    try:
+        yield
+    finally:
+        record_stage(stage, monotonic() - started)
 
 SKLAD_FILE = os.path.join(WORKING_DIR, "sklad.xlsx")
 REESTR_FILE = os.path.join(WORKING_DIR, "reestr.xlsx")
@@ -32,202 +169,337 @@ RESULT_COLUMNS = [
     "Соп - ие", "КОММЕНТАРИИ"
 ]
 
-def load_excel_files():
-    """Load the input Excel files into pandas DataFrames."""
+# Version of the result for the same input files; bump it when a change to
+# matching or formatting changes exit.xlsx so cached results are not reused
+RESULT_VERSION = 1
+
+# Rows at the top of a sheet that are searched for the header row
+HEADER_SCAN_ROWS = 10
+
+# Expected column name patterns
+SKLAD_EXPECTED = ['код', 'наименование', 'единица', 'организация', 'номер', 'период', 'количество']
+REESTR_EXPECTED = ['id', 'наименование', 'кол-во', 'компания', 'номера', 'дата', 'цена']
+
+def find_header_row(df, expected_columns):
+    """Index of the first of the top rows of df that contains at least 3 expected column names."""
+    with timed_stage('header_detection'):
+        return _find_header_row(df, expected_columns)
+
+def _find_header_row(df, expected_columns):
+    for row_idx in range(min(HEADER_SCAN_ROWS, len(df))):  # Check first 10 rows
+        row_values = df.iloc[row_idx].astype(str).str.lower()
+        matches = sum(1 for col in expected_columns if any(col.lower() in val for val in row_values))
+        if matches >= 3:  # If we find at least 3 matches, consider it a header row
+            return row_idx
+    return 0  # Default to first row if no match found
+
+def calamine_available():
+    """Whether pandas can read xlsx with the calamine engine (pandas >= 2.2 and python-calamine)."""
     try:
-        # First, let's read the Excel files without headers to inspect the structure
-        sklad_df_raw = pd.read_excel(SKLAD_FILE, header=None, engine='openpyxl')
-        reestr_df_raw = pd.read_excel(REESTR_FILE, header=None, engine='openpyxl')
-        
-        logger.info("Raw data structure from sklad.xlsx:")
-        logger.info(sklad_df_raw.head().to_string())
-        logger.info("\nRaw data structure from reestr.xlsx:")
-        logger.info(reestr_df_raw.head().to_string())
-        
-        # Try to find the header row by looking for expected column names
-        def find_header_row(df, expected_columns):
-            for row_idx in range(min(10, len(df))):  # Check first 10 rows
-                row_values = df.iloc[row_idx].astype(str).str.lower()
-                matches = sum(1 for col in expected_columns if any(col.lower() in val for val in row_values))
-                if matches >= 3:  # If we find at least 3 matches, consider it a header row
-                    return row_idx
-            return 0  # Default to first row if no match found
-        
-        # Expected column name patterns
-        sklad_expected = ['код', 'наименование', 'единица', 'организация', 'номер', 'период', 'количество']
-        reestr_expected = ['id', 'наименование', 'кол-во', 'компания', 'номера', 'дата', 'цена']
-        
-        # Find header rows
-        sklad_header_row = find_header_row(sklad_df_raw, sklad_expected)
-        reestr_header_row = find_header_row(reestr_df_raw, reestr_expected)
-        
-        logger.info(f"Detected header row in sklad.xlsx: {sklad_header_row}")
-        logger.info(f"Detected header row in reestr.xlsx: {reestr_header_row}")
-        
-        # Read the files with the detected header rows
-        sklad_df = pd.read_excel(SKLAD_FILE, header=sklad_header_row, engine='openpyxl')
-        reestr_df = pd.read_excel(REESTR_FILE, header=reestr_header_row, engine='openpyxl')
-        
-        # Clean column names
-        sklad_df.columns = sklad_df.columns.str.strip()
-        reestr_df.columns = reestr_df.columns.str.strip()
+        import python_calamine  # noqa: F401
+    except ImportError:
+        return False
+    major, minor = (int(part) for part in pd.__version__.split('.')[:2])
+    return (major, minor) >= (2, 2)
+
+def get_excel_engine(engine=None):
+    """Resolve the reader engine setting (EXCEL_ENGINE by default) to 'calamine' or 'openpyxl'."""
+    engine = engine or EXCEL_ENGINE
+    if engine == 'auto':
+        return 'calamine' if calamine_available() else 'openpyxl'
+    if engine == 'calamine' and not calamine_available():
+        logger.warning("python-calamine не установлен, читаем файлы через openpyxl")
+        return 'openpyxl'
+    return engine
+
+def read_excel_with_header(file_path, expected_columns, engine=None):
+    """Read the first sheet of file_path with its detected header row.
+
+    The workbook is opened once: the header row is detected on the first
+    HEADER_SCAN_ROWS rows, then the sheet is parsed in full with that header.
+    """
+    engine = get_excel_engine(engine)
+    logger.info(f"Reading {os.path.basename(file_path)} with engine '{engine}'")
+    with pd.ExcelFile(file_path, engine=engine) as xls:
+        df_raw = xls.parse(header=None, nrows=HEADER_SCAN_ROWS)
+        logger.debug("Raw data structure from %s:", os.path.basename(file_path))
+        logger.debug("%s", LazyLog(lambda: df_raw.head().to_string()))
+
+        header_row = find_header_row(df_raw, expected_columns)
+        logger.info(f"Detected header row in {os.path.basename(file_path)}: {header_row}")
+
+        df = xls.parse(header=header_row)
+    return df, header_row
+
+# Reestr columns are taken by position (0-based): position -> column name
+REESTR_COLUMN_POSITIONS = {
+    6: 'ID счёта',  # Column 7
+    5: 'Наименование в счёте',  # Column 6
+    17: 'Кол-во в счёте в Ед. Изм. в счёте',  # Column 18
+    4: 'Компания поставщик',  # Column 5
+    9: 'Номера платёжных поручений',  # Column 10
+    8: 'Дата последнего платежа',  # Column 9
+    21: 'Цена за ед.'  # Column 22
+}
+
+# Sklad columns that already carry the result names, see map_sklad_columns
+SKLAD_DIRECT_COLUMNS = {
+    'код': 'Номенклатура.Код',
+    'предмет': 'Номенклатура.Наименование',
+    'ед.изм': 'Единица',
+    'плательщик': 'Документ связи.Организация',
+    '№ перемещения': 'Регистратор.Номер',
+    'дата перемещения': 'Период, день.Начало дня',
+    'кол-во в перемещении': 'Количество Приход',
+}
+
+def map_reestr_columns(columns):
+    """Map the reestr column names to the expected names by their known positions."""
+    # Map known column indices for reestr (adjusting for 0-based indexing)
+    column_mapping = {columns[pos]: name for pos, name in REESTR_COLUMN_POSITIONS.items()}
+
+    # Log the actual column names and their mappings
+    logger.debug("Reestr column mappings:")
+    for orig_col, new_col in column_mapping.items():
+        logger.debug("  %s -> %s", orig_col, new_col)
+    return column_mapping
+
+def map_sklad_columns(columns):
+    """Map the sklad column names to the expected names by name patterns."""
+    column_mapping = {}
+
+    # For sklad, use specific pattern matching to avoid duplicates
+    for col in columns:
+        col_lower = str(col).lower().strip()
         
-        # Map the actual column names to expected names
-        def map_columns(df, expected_patterns, is_reestr=False):
+        # Точное соответствие для избежания дублирования
+        if col_lower == 'код':
+            column_mapping[col] = 'Номенклатура.Код'
+            logger.debug("Mapped column '%s' -> 'Номенклатура.Код'", col)
+        elif col_lower == 'предмет' or 'наименование' in col_lower:
+            column_mapping[col] = 'Номенклатура.Наименование'
+            logger.debug("Mapped column '%s' -> 'Номенклатура.Наименование'", col)
+        elif col_lower == 'ед.изм' or col_lower == 'единица':
+            column_mapping[col] = 'Единица'
+            logger.debug("Mapped column '%s' -> 'Единица'", col)
+        elif col_lower == 'плательщик' or 'организация' in col_lower:
+            column_mapping[col] = 'Документ связи.Организация'
+            logger.debug("Mapped column '%s' -> 'Документ связи.Организация'", col)
+        elif col_lower == '№ перемещения' or (col_lower == 'номер' and 'перемещ' in col_lower):
+            column_mapping[col] = 'Регистратор.Номер'
+            logger.debug("Mapped column '%s' -> 'Регистратор.Номер'", col)
+        elif col_lower == 'дата перемещения':
+            column_mapping[col] = 'Период, день.Начало дня'
+            logger.debug("Mapped column '%s' -> 'Период, день.Начало дня'", col)
+        elif col_lower == 'кол-во в перемещении':
+            column_mapping[col] = 'Количество Приход'
+            logger.debug("Mapped column '%s' -> 'Количество Приход'", col)
+
+    # Check for duplicate values in sklad_mapping
+    if column_mapping:
+        mapping_values = list(column_mapping.values())
+        duplicate_values = [v for v in set(mapping_values) if mapping_values.count(v) > 1]
+        if duplicate_values:
+            logger.error(f"ОШИБКА: Найдены дублирующиеся значения в маппинге: {duplicate_values}")
+            logger.info("Очищаем маппинг и используем резервную логику...")
             column_mapping = {}
-            
-            # For reestr, we know the column indices
-            if is_reestr:
-                # Map known column indices for reestr (adjusting for 0-based indexing)
-                column_mapping = {
-                    df.columns[6]: 'ID счёта',  # Column 7
-                    df.columns[5]: 'Наименование в счёте',  # Column 6
-                    df.columns[17]: 'Кол-во в счёте в Ед. Изм. в счёте',  # Column 18
-                    df.columns[4]: 'Компания поставщик',  # Column 5
-                    df.columns[9]: 'Номера платёжных поручений',  # Column 10
-                    df.columns[8]: 'Дата последнего платежа',  # Column 9
-                    df.columns[21]: 'Цена за ед.'  # Column 22
-                }
-                
-                # Log the actual column names and their mappings
-                logger.info("Reestr column mappings:")
-                for orig_col, new_col in column_mapping.items():
-                    logger.info(f"  {orig_col} -> {new_col}")
-            else:
-                # For sklad, use specific pattern matching to avoid duplicates
-                for col in df.columns:
-                    col_lower = str(col).lower().strip()
-                    
-                    # Точное соответствие для избежания дублирования
-                    if col_lower == 'код':
-                        column_mapping[col] = 'Номенклатура.Код'
-                        logger.info(f"Mapped column '{col}' -> 'Номенклатура.Код'")
-                    elif col_lower == 'предмет' or 'наименование' in col_lower:
-                        column_mapping[col] = 'Номенклатура.Наименование'
-                        logger.info(f"Mapped column '{col}' -> 'Номенклатура.Наименование'")
-                    elif col_lower == 'ед.изм' or col_lower == 'единица':
-                        column_mapping[col] = 'Единица'
-                        logger.info(f"Mapped column '{col}' -> 'Единица'")
-                    elif col_lower == 'плательщик' or 'организация' in col_lower:
-                        column_mapping[col] = 'Документ связи.Организация'
-                        logger.info(f"Mapped column '{col}' -> 'Документ связи.Организация'")
-                    elif col_lower == '№ перемещения' or (col_lower == 'номер' and 'перемещ' in col_lower):
-                        column_mapping[col] = 'Регистратор.Номер'
-                        logger.info(f"Mapped column '{col}' -> 'Регистратор.Номер'")
-                    elif col_lower == 'дата перемещения':
-                        column_mapping[col] = 'Период, день.Начало дня'
-                        logger.info(f"Mapped column '{col}' -> 'Период, день.Начало дня'")
-                    elif col_lower == 'кол-во в перемещении':
-                        column_mapping[col] = 'Количество Приход'
-                        logger.info(f"Mapped column '{col}' -> 'Количество Приход'")
-            return column_mapping
-        
-        # Map columns for both dataframes
-        sklad_mapping = map_columns(sklad_df, sklad_expected)
-        reestr_mapping = map_columns(reestr_df, reestr_expected, is_reestr=True)
-        
-        logger.info("Detected column mappings for sklad.xlsx:")
-        logger.info(sklad_mapping)
-        logger.info("Detected column mappings for reestr.xlsx:")
-        logger.info(reestr_mapping)
-        
-        # Additional debugging: log all original column names
-        logger.info("Original sklad.xlsx column names:")
-        for i, col in enumerate(sklad_df.columns):
-            logger.info(f"  Column {i}: '{col}'")
-        
-        logger.info("Original reestr.xlsx column names:")  
-        for i, col in enumerate(reestr_df.columns):
-            logger.info(f"  Column {i}: '{col}'")
-        
-        # Check for duplicate values in sklad_mapping
-        if sklad_mapping:
-            mapping_values = list(sklad_mapping.values())
-            duplicate_values = [v for v in set(mapping_values) if mapping_values.count(v) > 1]
-            if duplicate_values:
-                logger.error(f"ОШИБКА: Найдены дублирующиеся значения в маппинге: {duplicate_values}")
-                logger.info("Очищаем маппинг и используем резервную логику...")
-                sklad_mapping = {}
-        
-        # Check if we found any mappings for sklad or use fallback
-        if not sklad_mapping:
-            logger.warning("Не найдено корректного маппинга для sklad.xlsx! Попробуем резервную логику.")
-            
-            # Анализируем структуру файла из логов - видим что колонки уже правильно названы
-            logger.info("Обнаружено, что файл sklad.xlsx уже имеет правильные названия колонок.")
-            
-            # Создаем прямое соответствие для известных колонок
-            direct_mapping = {}
-            for col in sklad_df.columns:
-                col_str = str(col).strip()
-                if col_str == 'код':
-                    direct_mapping[col] = 'Номенклатура.Код'
-                elif col_str == 'предмет':
-                    direct_mapping[col] = 'Номенклатура.Наименование'
-                elif col_str == 'ед.изм':
-                    direct_mapping[col] = 'Единица'
-                elif col_str == 'плательщик':
-                    direct_mapping[col] = 'Документ связи.Организация'
-                elif col_str == '№ перемещения':
-                    direct_mapping[col] = 'Регистратор.Номер'
-                elif col_str == 'дата перемещения':
-                    direct_mapping[col] = 'Период, день.Начало дня'
-                elif col_str == 'кол-во в перемещении':
-                    direct_mapping[col] = 'Количество Приход'
-            
-            sklad_mapping = direct_mapping
-            logger.info(f"Применено прямое соответствие колонок: {sklad_mapping}")
-        
-        # Rename columns with error handling
-        try:
-            logger.info(f"Attempting to rename sklad columns with mapping: {sklad_mapping}")
-            if sklad_mapping:
-                sklad_df = sklad_df.rename(columns=sklad_mapping)
-            else:
-                logger.warning("Пропускаем переименование колонок sklad - маппинг пустой")
-            
-            logger.info(f"Attempting to rename reestr columns with mapping: {reestr_mapping}")
-            if reestr_mapping:
-                reestr_df = reestr_df.rename(columns=reestr_mapping)
-            else:
-                logger.warning("Пропускаем переименование колонок reestr - маппинг пустой")
-                
-        except Exception as e:
-            logger.error(f"Ошибка при переименовании колонок: {e}")
-            logger.info("Используем исходные названия колонок без переименования")
-            # Перечитываем файлы без переименования
-            sklad_df = pd.read_excel(SKLAD_FILE, header=sklad_header_row, engine='openpyxl')
-            reestr_df = pd.read_excel(REESTR_FILE, header=reestr_header_row, engine='openpyxl')
-            sklad_df.columns = sklad_df.columns.str.strip()
-            reestr_df.columns = reestr_df.columns.str.strip()
-        
-        # Clean data - replace NaN with empty string for string columns
-        string_columns_sklad = sklad_df.select_dtypes(include=['object']).columns
-        string_columns_reestr = reestr_df.select_dtypes(include=['object']).columns
-        
-        sklad_df[string_columns_sklad] = sklad_df[string_columns_sklad].fillna('')
-        reestr_df[string_columns_reestr] = reestr_df[string_columns_reestr].fillna('')
-        
-        # Debug logging
-        logger.info(f"Final sklad.xlsx columns: {sklad_df.columns.tolist()}")
-        logger.info(f"Final reestr.xlsx columns: {reestr_df.columns.tolist()}")
-        
-        # Log sample data
-        logger.info("Sample data from sklad.xlsx:")
-        logger.info(sklad_df.head().to_string())
-        logger.info("Sample data from reestr.xlsx:")
-        logger.info(reestr_df.head().to_string())
+    
+    # Check if we found any mappings for sklad or use fallback
+    if not column_mapping:
+        logger.warning("Не найдено корректного маппинга для sklad.xlsx! Попробуем резервную логику.")
         
-        # Log a few rows from reestr to verify data
-        logger.info("Sample rows from reestr.xlsx (Наименование в счёте):")
-        for idx, row in reestr_df.head(5).iterrows():
-            logger.info(f"Row {idx}: {row['Наименование в счёте']}")
+        # Анализируем структуру файла из логов - видим что колонки уже правильно названы
+        logger.info("Обнаружено, что файл sklad.xlsx уже имеет правильные названия колонок.")
         
+        # Создаем прямое соответствие для известных колонок
+        column_mapping = {col: SKLAD_DIRECT_COLUMNS[str(col).strip()]
+                          for col in columns if str(col).strip() in SKLAD_DIRECT_COLUMNS}
+        logger.info(f"Применено прямое соответствие колонок: {column_mapping}")
+    return column_mapping
+
+def read_mapped_excel(file_path, expected_columns, map_columns):
+    """Read one input file with pd.read_excel and rename its columns with map_columns."""
+    file_name = os.path.basename(file_path)
+    df, header_row = read_excel_with_header(file_path, expected_columns)
+
+    # Clean column names
+    df.columns = df.columns.str.strip()
+
+    # Additional debugging: log all original column names
+    logger.debug("Original %s column names:", file_name)
+    for i, col in enumerate(df.columns):
+        logger.debug("  Column %s: '%s'", i, col)
+
+    column_mapping = map_columns(df.columns)
+    logger.info(f"Detected column mappings for {file_name}:")
+    logger.info(column_mapping)
+
+    # Rename columns with error handling
+    try:
+        logger.debug("Attempting to rename %s columns with mapping: %s", file_name, column_mapping)
+        if column_mapping:
+            df = df.rename(columns=column_mapping)
+        else:
+            logger.warning(f"Пропускаем переименование колонок {file_name} - маппинг пустой")
+    except Exception as e:
+        # rename не меняет исходную таблицу, остаёмся на ней
+        logger.error(f"Ошибка при переименовании колонок: {e}")
+        logger.info("Используем исходные названия колонок без переименования")
+    return df
+
+def load_sklad_file(sklad_file):
+    """Load the sklad file with EXCEL_LOADER."""
+    if EXCEL_LOADER == 'stream':
+        sklad_df = stream_excel_columns(sklad_file, SKLAD_EXPECTED, select_sklad_columns)
+    else:
+        sklad_df = read_mapped_excel(sklad_file, SKLAD_EXPECTED, map_sklad_columns)
+    return fill_string_columns(sklad_df)
+
+def load_reestr_file(reestr_file):
+    """Load the reestr file with EXCEL_LOADER."""
+    if EXCEL_LOADER == 'stream':
+        reestr_df = stream_excel_columns(reestr_file, REESTR_EXPECTED, select_reestr_columns)
+    else:
+        reestr_df = read_mapped_excel(reestr_file, REESTR_EXPECTED, map_reestr_columns)
+    return fill_string_columns(reestr_df)
+
+def load_excel_files(sklad_file=None, reestr_file=None):
+    """Load the input Excel files (SKLAD_FILE and REESTR_FILE by default) into pandas DataFrames.
+
+    The reestr is returned with its normalized names and comes from the
+    parsed-reestr cache when the same file was loaded before, see
+    load_reestr.
+    """
+    sklad_file = sklad_file or SKLAD_FILE
+    reestr_file = reestr_file or REESTR_FILE
+    try:
+        sklad_df = load_sklad_file(sklad_file)
+        reestr_df = load_reestr(reestr_file)
+        log_loaded_samples(sklad_df, reestr_df)
         return sklad_df, reestr_df
     except Exception as e:
         logger.error(f"Error loading Excel files: {e}")
         raise
 
+def fill_string_columns(df):
+    """Clean data - replace NaN with empty string for string columns."""
+    string_columns = df.select_dtypes(include=['object']).columns
+    df[string_columns] = df[string_columns].fillna('')
+    return df
+
+def log_loaded_samples(sklad_df, reestr_df):
+    # Debug logging
+    logger.info(f"Final sklad.xlsx columns: {sklad_df.columns.tolist()}")
+    logger.info(f"Final reestr.xlsx columns: {reestr_df.columns.tolist()}")
+    
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+
+    # Log sample data
+    logger.debug("Sample data from sklad.xlsx:")
+    logger.debug("%s", sklad_df.head().to_string())
+    logger.debug("Sample data from reestr.xlsx:")
+    logger.debug("%s", reestr_df.head().to_string())
+    
+    # Log a few rows from reestr to verify data
+    logger.debug("Sample rows from reestr.xlsx (Наименование в счёте):")
+    for idx, row in reestr_df.head(5).iterrows():
+        logger.debug("Row %s: %s", idx, row['Наименование в счёте'])
+
+def _convert_cell_value(value):
+    """Cell value as pandas' openpyxl reader passes it to the parser."""
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+def _parse_column(name, values):
+    """Convert the raw values of one column to a Series the way pd.read_excel does."""
+    parser = TextParser([[value] for value in values], header=None, names=[name],
+                        skip_blank_lines=False)
+    return parser.read()[name]
+
+def stream_excel_columns(file_path, expected_columns, select_columns):
+    """Read the columns picked by select_columns of the first sheet of file_path in one streaming pass.
+
+    select_columns(header names) returns {position: new name}; values are converted like pd.read_excel.
+    """
+    file_name = os.path.basename(file_path)
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True, keep_links=False)
+    try:
+        ws = wb.worksheets[0]
+        ws.reset_dimensions()
+        rows = ws.iter_rows(values_only=True)
+
+        def next_values():
+            for row in rows:
+                values = [_convert_cell_value(value) for value in row]
+                while values and values[-1] == "":
+                    values.pop()
+                yield values
+
+        values_iter = next_values()
+        prefix = list(itertools.islice(values_iter, HEADER_SCAN_ROWS))
+        scan_rows = list(prefix)
+        while scan_rows and not scan_rows[-1]:
+            scan_rows.pop()
+        scan_width = max((len(values) for values in scan_rows), default=0)
+        scan_rows = [values + [""] * (scan_width - len(values)) for values in scan_rows]
+        df_raw = TextParser(scan_rows, header=None, skip_blank_lines=False).read() if scan_rows else pd.DataFrame()
+        logger.debug("Raw data structure from %s:", file_name)
+        logger.debug("%s", LazyLog(lambda: df_raw.head().to_string()))
+
+        header_row = find_header_row(df_raw, expected_columns)
+        logger.info(f"Detected header row in {file_name}: {header_row}")
+
+        header_values = scan_rows[header_row] if header_row < len(scan_rows) else []
+        names = TextParser([header_values], header=0).read().columns if header_values else pd.Index([])
+        names = names.str.strip() if len(names) else names
+        selected = select_columns(names)
+
+        columns = {pos: [] for pos in selected}
+        width = len(header_values)
+        row_count = 0
+        pending_blank = 0
+        for values in itertools.chain(prefix[header_row + 1:], values_iter):
+            if not values:
+                # Пустые строки в конце листа pandas отбрасывает
+                pending_blank += 1
+                continue
+            width = max(width, len(values))
+            for pos, column in columns.items():
+                if pending_blank:
+                    column.extend([""] * pending_blank)
+                column.append(values[pos] if pos < len(values) else "")
+            row_count += pending_blank + 1
+            pending_blank = 0
+    finally:
+        wb.close()
+
+    if selected and max(selected) >= width:
+        raise IndexError(f"index {max(selected)} is out of bounds for axis 0 with size {width}")
+
+    df = pd.DataFrame({selected[pos]: _parse_column(selected[pos], columns.pop(pos)) for pos in sorted(selected)},
+                      index=pd.RangeIndex(row_count))
+    logger.info(f"Streamed {len(df)} rows, {len(df.columns)} of {width} columns from {file_name}")
+    return df
+
+def select_sklad_columns(names):
+    """Columns of the sklad sheet the 'stream' loader keeps, by position."""
+    sklad_mapping = map_sklad_columns(names)
+    logger.info("Detected column mappings for sklad.xlsx:")
+    logger.info(sklad_mapping)
+    # Оставляем все колонки, которые читает create_result_dataframe,
+    # в том числе не переименованные
+    used_names = set(SKLAD_DIRECT_COLUMNS) | set(SKLAD_DIRECT_COLUMNS.values())
+    final_names = [sklad_mapping.get(name, name) for name in names]
+    return {pos: name for pos, name in enumerate(final_names) if name in used_names}
+
+def select_reestr_columns(names):
+    """Columns of the reestr sheet the 'stream' loader keeps, by position."""
+    return dict(REESTR_COLUMN_POSITIONS)
+
 def get_excel_styles(file_path):
     """Extract formatting styles from the source Excel file."""
     wb = openpyxl.load_workbook(file_path)
@@ -286,6 +558,26 @@ def compare_strings_advanced(str1, str2):
 
     norm1 = normalize_text(str1)
     norm2 = normalize_text(str2)
+    return compare_normalized(norm1, set(norm1.split()), norm2, set(norm2.split()))
+
+# Jaccard index above which two names match at level 2 and level 1
+JACCARD_LEVEL2 = 0.6
+JACCARD_LEVEL1 = 0.4
+
+def jaccard_possible(count1, count2, threshold=JACCARD_LEVEL1):
+    """Whether token sets of count1 and count2 tokens can have a Jaccard index above threshold.
+
+    The index is at most min/max of the set sizes (one set inside the other).
+    """
+    return min(count1, count2) / max(count1, count2) > threshold
+
+def compare_normalized(norm1, set1, norm2, set2):
+    """compare_strings_advanced on precomputed normalized strings and token sets.
+
+    None stands for an empty value and never matches.
+    """
+    if norm1 is None or norm2 is None:
+        return 0
 
     # Точное совпадение
     if norm1 == norm2:
@@ -296,179 +588,1384 @@ def compare_strings_advanced(str1, str2):
         return 2
 
     # Совпадение по ключевым словам
-    set1 = set(norm1.split())
-    set2 = set(norm2.split())
     intersection = set1 & set2
     union = set1 | set2
     if not union:
         return 0
     jaccard = len(intersection) / len(union)
-    if jaccard > 0.6:
+    if jaccard > JACCARD_LEVEL2:
         return 2
-    elif jaccard > 0.4:
+    elif jaccard > JACCARD_LEVEL1:
         return 1
     else:
         return 0
 
-def create_result_dataframe(sklad_df, reestr_df):
-    """Create the result DataFrame based on the transformation algorithm."""
-    result_data = []
-    
+# Precomputed normalized form of the item names, see add_normalized_columns
+NORM_COLUMN = "_norm"
+TOKENS_COLUMN = "_tokens"
+NORM_LENGTH_COLUMN = "_norm_len"
+
+def get_item_names(sklad_df):
+    """Item names of the sklad rows ("Номенклатура.Наименование" or "предмет")."""
+    for col in ("Номенклатура.Наименование", "предмет"):
+        if col in sklad_df.columns:
+            return sklad_df[col]
+    return pd.Series([""] * len(sklad_df), index=sklad_df.index, dtype=object)
+
+def get_reestr_names(reestr_df):
+    """Names of the reestr rows ("Наименование в счёте")."""
+    if "Наименование в счёте" in reestr_df.columns:
+        return reestr_df["Наименование в счёте"]
+    return pd.Series([""] * len(reestr_df), index=reestr_df.index, dtype=object)
+
+def normalize_names(names):
+    """Normalize each name once: lists of normalized strings, token sets and lengths.
+
+    Empty values, for which compare_strings_advanced returns 0, get None
+    instead of a normalized string and an empty token set.
+    """
+    norms, token_sets, lengths = [], [], []
+    for name in names:
+        if not name:
+            norms.append(None)
+            token_sets.append(frozenset())
+            lengths.append(0)
+            continue
+        norm = normalize_text(name)
+        norms.append(norm)
+        token_sets.append(frozenset(norm.split()))
+        lengths.append(len(norm))
+    return norms, token_sets, lengths
+
+def add_normalized_columns(df, names):
+    """Store the normalized form of names in the NORM_*/TOKENS columns of df."""
+    norms, token_sets, lengths = normalize_names(names.tolist())
+    df[NORM_COLUMN] = pd.Series(norms, index=df.index, dtype=object)
+    df[TOKENS_COLUMN] = pd.Series(token_sets, index=df.index, dtype=object)
+    df[NORM_LENGTH_COLUMN] = lengths
+    return df
+
+def prepare_normalized(sklad_df, reestr_df):
+    """Normalize the sklad item names and reestr names once after load_excel_files."""
+    if NORM_COLUMN not in sklad_df.columns:
+        add_normalized_columns(sklad_df, get_item_names(sklad_df))
+    if NORM_COLUMN not in reestr_df.columns:
+        add_normalized_columns(reestr_df, get_reestr_names(reestr_df))
+    logger.info(f"Normalized names: sklad={len(sklad_df)}, reestr={len(reestr_df)}")
+    return sklad_df, reestr_df
+
+# Layout version of the parsed-reestr cache; bump it when the cached columns
+# or normalize_text change
+REESTR_CACHE_VERSION = 2
+# reestr_df.attrs key of the reestr version (its cache key), set by load_reestr
+REESTR_VERSION_ATTR = 'reestr_version'
+
+def file_digest(path):
+    """SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def reestr_cache_key(reestr_file):
+    """Parsed-reestr cache key: hash of the file and of the loader settings."""
+    settings = {'version': REESTR_CACHE_VERSION, 'loader': EXCEL_LOADER, 'engine': get_excel_engine()}
+    digest = hashlib.sha256(file_digest(reestr_file).encode())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+def _cache_array_path(directory, name):
+    return os.path.join(directory, f'{name}.npy')
+
+def _save_strings(directory, name, strings):
+    """Save strings as one UTF-8 blob (<name>_data) and their int64 offsets (<name>_offsets).
+
+    The offsets are in characters of the decoded blob, so every string
+    takes only its own length instead of the longest one's.
+    """
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    data = ''.join(strings).encode('utf-8', 'surrogatepass')
+    np.save(_cache_array_path(directory, f'{name}_data'), np.frombuffer(data, dtype=np.uint8))
+    np.save(_cache_array_path(directory, f'{name}_offsets'), offsets)
+
+def _load_strings(directory, name):
+    """The list of strings saved by _save_strings."""
+    text = np.load(_cache_array_path(directory, f'{name}_data')).tobytes().decode('utf-8', 'surrogatepass')
+    offsets = np.load(_cache_array_path(directory, f'{name}_offsets')).tolist()
+    return [text[start:end] for start, end in zip(offsets, offsets[1:])]
+
+def store_cached_reestr(cache_key, reestr_df):
+    """Save the normalized reestr in REESTR_CACHE_DIR/cache_key.
+
+    Only the REESTR_COLUMN_POSITIONS columns are kept: numeric and date
+    columns as .npy arrays, text columns with _save_strings and mixed
+    columns as object arrays. The normalized names are stored with
+    _save_strings and a mask of empty values, the token sets as a
+    vocabulary (_save_strings) with CSR-style indptr/indices arrays.
+    """
+    columns = [col for col in REESTR_COLUMN_POSITIONS.values() if col in reestr_df.columns]
+    if (not reestr_df.index.equals(pd.RangeIndex(len(reestr_df)))
+            or any((reestr_df.columns == col).sum() > 1 for col in columns)
+            or not all(isinstance(reestr_df[col].dtype, np.dtype) for col in columns)):
+        logger.info("Reestr is not cached: unsupported index or column types")
+        return
+    directory = os.path.join(REESTR_CACHE_DIR, cache_key)
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        return
+    temp_dir = f'{directory}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.makedirs(temp_dir)
+        column_info = []
+        for col_pos, col in enumerate(columns):
+            values = reestr_df[col].to_numpy()
+            if values.dtype != object:
+                kind = 'array'
+            elif all(isinstance(value, str) for value in values):
+                kind = 'text'
+            else:
+                kind = 'object'
+            if kind == 'text':
+                _save_strings(temp_dir, f'column{col_pos}', values.tolist())
+            else:
+                np.save(_cache_array_path(temp_dir, f'column{col_pos}'), values, allow_pickle=True)
+            column_info.append({'name': col, 'kind': kind})
+
+        norms = reestr_df[NORM_COLUMN].tolist()
+        _save_strings(temp_dir, 'norm', ['' if norm is None else norm for norm in norms])
+        np.save(_cache_array_path(temp_dir, 'norm_missing'), np.array([norm is None for norm in norms], dtype=bool))
+        np.save(_cache_array_path(temp_dir, 'norm_len'), reestr_df[NORM_LENGTH_COLUMN].to_numpy())
+        vocabulary, indices, indptr = {}, [], [0]
+        for tokens in reestr_df[TOKENS_COLUMN]:
+            indices.extend(vocabulary.setdefault(token, len(vocabulary)) for token in tokens)
+            indptr.append(len(indices))
+        _save_strings(temp_dir, 'token_vocab', list(vocabulary))
+        np.save(_cache_array_path(temp_dir, 'token_indptr'), np.array(indptr, dtype=np.int64))
+        np.save(_cache_array_path(temp_dir, 'token_indices'), np.array(indices, dtype=np.int64))
+
+        with open(os.path.join(temp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump({'rows': len(reestr_df), 'columns': column_info}, f, ensure_ascii=False)
+        # Папка без meta.json - остаток неполной записи, её заменяем целиком
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temp_dir, directory)
+        logger.info(f"Stored parsed reestr in cache {cache_key}")
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить реестр в кэш: {e}")
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return
+    evict_cached_reestrs()
+
+def load_cached_reestr(cache_key):
+    """The reestr stored by store_cached_reestr under cache_key, or None.
+
+    Numeric and date columns are memory-mapped from their .npy files.
+    """
+    directory = os.path.join(REESTR_CACHE_DIR, cache_key)
+    if not os.path.exists(os.path.join(directory, 'meta.json')):
+        return None
+    try:
+        with open(os.path.join(directory, 'meta.json'), encoding='utf-8') as f:
+            meta = json.load(f)
+        data = {}
+        for col_pos, column in enumerate(meta['columns']):
+            path = _cache_array_path(directory, f'column{col_pos}')
+            if column['kind'] == 'array':
+                data[column['name']] = np.load(path, mmap_mode='r')
+            elif column['kind'] == 'text':
+                data[column['name']] = np.array(_load_strings(directory, f'column{col_pos}'), dtype=object)
+            else:
+                data[column['name']] = np.load(path, allow_pickle=True)
+        index = pd.RangeIndex(meta['rows'])
+        reestr_df = pd.DataFrame(data, index=index, columns=[column['name'] for column in meta['columns']])
+
+        norm_missing = np.load(_cache_array_path(directory, 'norm_missing')).tolist()
+        norms = [None if missing else norm for norm, missing in
+                 zip(_load_strings(directory, 'norm'), norm_missing)]
+        vocabulary = _load_strings(directory, 'token_vocab')
+        indptr = np.load(_cache_array_path(directory, 'token_indptr'), mmap_mode='r').tolist()
+        indices = np.load(_cache_array_path(directory, 'token_indices'), mmap_mode='r').tolist()
+        token_sets = [frozenset(map(vocabulary.__getitem__, indices[start:end]))
+                      for start, end in zip(indptr, indptr[1:])]
+        reestr_df[NORM_COLUMN] = pd.Series(norms, index=index, dtype=object)
+        reestr_df[TOKENS_COLUMN] = pd.Series(token_sets, index=index, dtype=object)
+        reestr_df[NORM_LENGTH_COLUMN] = np.load(_cache_array_path(directory, 'norm_len'))
+    except (OSError, ValueError, KeyError, UnicodeDecodeError) as e:
+        logger.warning(f"Не удалось прочитать реестр из кэша {cache_key}: {e}")
+        return None
+    os.utime(directory)  # время изменения папки - время последнего использования
+    return reestr_df
+
+def _directory_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+def evict_cached_reestrs():
+    """Keep the most recently used reestrs in REESTR_CACHE_DIR.
+
+    At most REESTR_CACHE_ENTRIES of them and REESTR_CACHE_MAX_BYTES in total
+    are kept.
+    """
+    entries = []
+    for name in os.listdir(REESTR_CACHE_DIR):
+        path = os.path.join(REESTR_CACHE_DIR, name)
+        if '.' not in name and os.path.isdir(path):
+            entries.append((os.path.getmtime(path), path))
+    kept = total_size = 0
+    for _, path in sorted(entries, reverse=True):
+        size = _directory_size(path)
+        if kept < REESTR_CACHE_ENTRIES and total_size + size <= REESTR_CACHE_MAX_BYTES:
+            kept += 1
+            total_size += size
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"Evicted parsed reestr cache {os.path.basename(path)}")
+
+@contextmanager
+def gc_paused():
+    """Pause the cyclic garbage collector while building many small lists.
+
+    Postings have no reference cycles; collections started by their
+    allocations would only rescan the whole heap again and again.
+    """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+# Layout version of the cached index postings; bump it when
+# ReestrIndex.count_postings, build_ngram_postings or hash_ngrams change
+REESTR_INDEX_VERSION = 1
+
+def _cached_index_dir(cache_key):
+    return os.path.join(REESTR_CACHE_DIR, cache_key, f'index-v{REESTR_INDEX_VERSION}')
+
+def store_cached_index(cache_key, reestr_index):
+    """Save the postings of reestr_index in the cache entry of cache_key.
+
+    count_postings are stored like the token sets: one CSR-style row per
+    (token, token count) pair; the n-gram postings are saved as they are.
+    Entries that are missing or still being written are left alone.
+    """
+    directory = _cached_index_dir(cache_key)
+    if (not os.path.exists(os.path.join(REESTR_CACHE_DIR, cache_key, 'meta.json'))
+            or os.path.isdir(directory)):
+        return
+    temp_dir = f'{directory}.{uuid.uuid4().hex}.tmp'
+    try:
+        os.mkdir(temp_dir)  # не makedirs: удалённая запись кэша не должна появиться снова
+        tokens, counts, indices, indptr = [], [], [], [0]
+        for token, by_count in reestr_index.count_postings.items():
+            for token_count, rows in by_count.items():
+                tokens.append(token)
+                counts.append(token_count)
+                indices.extend(rows)
+                indptr.append(len(indices))
+        _save_strings(temp_dir, 'count_tokens', tokens)
+        np.save(_cache_array_path(temp_dir, 'count_counts'), np.array(counts, dtype=np.int64))
+        np.save(_cache_array_path(temp_dir, 'count_indptr'), np.array(indptr, dtype=np.int64))
+        np.save(_cache_array_path(temp_dir, 'count_rows'), np.array(indices, dtype=np.int32))
+        for name in ('ngram_hashes', 'ngram_indptr', 'ngram_rows'):
+            np.save(_cache_array_path(temp_dir, name), getattr(reestr_index, name))
+        os.replace(temp_dir, directory)
+        logger.info(f"Stored reestr index in cache {cache_key}")
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить индекс реестра в кэш: {e}")
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        return
+    evict_cached_reestrs()
+
+def load_cached_index(cache_key, size):
+    """(count_postings, n-gram postings) stored by store_cached_index for a reestr of size rows, or None."""
+    directory = _cached_index_dir(cache_key)
+    if not os.path.isdir(directory):
+        return None
+    try:
+        tokens = _load_strings(directory, 'count_tokens')
+        counts = np.load(_cache_array_path(directory, 'count_counts')).tolist()
+        indptr = np.load(_cache_array_path(directory, 'count_indptr')).tolist()
+        # Одни и те же объекты int для номеров строк во всех списках
+        row_objects = list(range(size))
+        rows = list(map(row_objects.__getitem__, np.load(_cache_array_path(directory, 'count_rows')).tolist()))
+        count_postings = {}
+        with gc_paused():
+            for token, token_count, start, end in zip(tokens, counts, indptr, indptr[1:]):
+                count_postings.setdefault(token, {})[token_count] = rows[start:end]
+        ngram_postings = tuple(np.load(_cache_array_path(directory, name))
+                               for name in ('ngram_hashes', 'ngram_indptr', 'ngram_rows'))
+    except (OSError, ValueError, IndexError, UnicodeDecodeError) as e:
+        logger.warning(f"Не удалось прочитать индекс реестра из кэша {cache_key}: {e}")
+        return None
+    return count_postings, ngram_postings
+
+def load_reestr(reestr_file):
+    """Load the reestr and normalize its names, through the parsed-reestr cache.
+
+    The cache is keyed by reestr_cache_key, so an unchanged reestr is read
+    from REESTR_CACHE_DIR instead of being parsed again. Cached reestrs only
+    have the columns create_result_dataframe reads.
+    """
+    cache_key = reestr_cache_key(reestr_file) if REESTR_CACHE_DIR else None
+    if cache_key:
+        reestr_df = load_cached_reestr(cache_key)
+        if reestr_df is not None:
+            logger.info(f"Loaded parsed reestr from cache {cache_key}: {len(reestr_df)} rows")
+            reestr_df.attrs[REESTR_VERSION_ATTR] = cache_key
+            return reestr_df
+    reestr_df = load_reestr_file(reestr_file)
+    add_normalized_columns(reestr_df, get_reestr_names(reestr_df))
+    if cache_key:
+        store_cached_reestr(cache_key, reestr_df)
+        reestr_df.attrs[REESTR_VERSION_ATTR] = cache_key
+    return reestr_df
+
+# Sklad columns identifying a movement for incremental matching (1C and short names)
+SKLAD_FINGERPRINT_COLUMNS = [
+    ("Номенклатура.Код", "код"),
+    ("Номенклатура.Наименование", "предмет"),
+    ("Регистратор.Номер", "№ перемещения"),
+    ("Период, день.Начало дня", "дата перемещения"),
+]
+FINGERPRINT_SIZE = 16
+
+def sklad_fingerprints(sklad_df):
+    """Fingerprint of every sklad row: a hash of its код, предмет, № перемещения and дата перемещения."""
+    columns = []
+    for names in SKLAD_FINGERPRINT_COLUMNS:
+        col = next((name for name in names if name in sklad_df.columns), None)
+        columns.append(sklad_df[col].tolist() if col else [""] * len(sklad_df))
+    return [hashlib.blake2b(repr(values).encode(), digest_size=FINGERPRINT_SIZE).digest()
+            for values in zip(*columns)]
+
+def _stored_matches_path(reestr_version):
+    # Совпадения зависят и от алгоритма сопоставления, поэтому в имени RESULT_VERSION
+    return os.path.join(REESTR_CACHE_DIR, reestr_version, f'matches-v{RESULT_VERSION}.npz')
+
+def load_stored_matches(reestr_version):
+    """Stored {fingerprint: (reestr row position, level)} for a reestr version."""
+    path = _stored_matches_path(reestr_version)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with np.load(path) as stored:
+            data = stored['fingerprints'].tobytes()
+            positions = stored['positions'].tolist()
+            levels = stored['levels'].tolist()
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(f"Не удалось прочитать сохранённые совпадения {path}: {e}")
+        return {}
+    fingerprints = [data[start:start + FINGERPRINT_SIZE] for start in range(0, len(data), FINGERPRINT_SIZE)]
+    return {fingerprint: (None if position < 0 else position, level)
+            for fingerprint, position, level in zip(fingerprints, positions, levels)}
+
+def save_stored_matches(reestr_version, matches):
+    """Replace the stored matches of a reestr version with {fingerprint: (position, level)}.
+
+    Nothing is saved when the reestr has no complete cache entry.
+    """
+    path = _stored_matches_path(reestr_version)
+    if not os.path.exists(os.path.join(os.path.dirname(path), 'meta.json')):
+        return
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp.npz'
+    try:
+        np.savez(temp_path,
+                 fingerprints=np.frombuffer(b''.join(matches), dtype=np.uint8),
+                 positions=np.array([-1 if position is None else position for position, _ in matches.values()],
+                                    dtype=np.int64),
+                 levels=np.array([level for _, level in matches.values()], dtype=np.int8))
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить совпадения {path}: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def find_matches_incremental(sklad_df, reestr_df, match_rows, progress):
+    """match_rows(norms, token_sets) for the sklad rows, reusing stored matches.
+
+    Matches are stored per reestr version (see REESTR_VERSION_ATTR) and
+    sklad_fingerprints row, so only rows that are new or changed since the
+    last run against the same reestr are matched. The stored matches are
+    replaced with the ones of the current sklad rows.
+    """
+    norms = sklad_df[NORM_COLUMN].tolist()
+    token_sets = sklad_df[TOKENS_COLUMN].tolist()
+    reestr_version = reestr_df.attrs.get(REESTR_VERSION_ATTR)
+    if not reestr_version or not REESTR_CACHE_DIR:
+        return match_rows(norms, token_sets)
+
+    fingerprints = sklad_fingerprints(sklad_df)
+    stored = load_stored_matches(reestr_version)
+    new_positions = [row_pos for row_pos, fingerprint in enumerate(fingerprints) if fingerprint not in stored]
+    logger.info(f"Incremental matching: {len(fingerprints) - len(new_positions)} rows reused, "
+                f"{len(new_positions)} rows to match")
+    progress.start_stage('match', len(new_positions))
+    new_matches = match_rows([norms[row_pos] for row_pos in new_positions],
+                             [token_sets[row_pos] for row_pos in new_positions])
+    for row_pos, match in zip(new_positions, new_matches):
+        stored[fingerprints[row_pos]] = match
+
+    current = {fingerprint: stored[fingerprint] for fingerprint in fingerprints}
+    if new_positions or len(current) != len(stored):
+        save_stored_matches(reestr_version, current)
+    return [current[fingerprint] for fingerprint in fingerprints]
+
+# Нечётные множители хэша n-граммы, по одному на символ
+NGRAM_HASH_MULTIPLIERS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F,
+                                   0x165667B19E3779F9, 0xD6E8FEB86659FD93], dtype=np.uint64)
+
+def text_codes(text):
+    """Code points of text as a uint32 array."""
+    return np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)
+
+def hash_ngrams(codes, size):
+    """32-bit hashes of the n-grams of size characters starting at each position of codes.
+
+    Different n-grams may share a hash, so rows found by one are candidates only.
+    """
+    count = len(codes) - size + 1
+    if count <= 0:
+        return np.empty(0, dtype=np.uint64)
+    codes = codes.astype(np.uint64)
+    hashes = codes[:count] * NGRAM_HASH_MULTIPLIERS[0]
+    for offset in range(1, size):
+        hashes += codes[offset:offset + count] * NGRAM_HASH_MULTIPLIERS[offset]
+    hashes >>= np.uint64(32)
+    return hashes
+
+def build_ngram_postings(first_by_norm, size):
+    """(hashes, indptr, rows) postings of the n-grams of the names in first_by_norm.
+
+    rows[indptr[i]:indptr[i + 1]] are the first rows, ascending, of the
+    names having an n-gram with the hash hashes[i]; hashes is sorted.
+    """
+    names = list(first_by_norm)
+    first_rows = np.fromiter(first_by_norm.values(), dtype=np.uint64, count=len(names))
+    lengths = np.fromiter(map(len, names), dtype=np.int64, count=len(names))
+    hashes = hash_ngrams(text_codes(ReestrIndex.SEPARATOR.join(names)), size)
+    # Номер имени для каждой позиции; n-граммы через разделитель не берём
+    name_ids = np.repeat(np.arange(len(names)), lengths + 1)[:len(hashes)]
+    ends = np.cumsum(lengths + 1) - 1
+    inside = np.arange(len(hashes)) + size <= ends[name_ids]
+
+    # Хэш и строка в одном числе: одна сортировка упорядочивает строки внутри хэша
+    pairs = np.sort((hashes[inside] << np.uint64(32)) | first_rows[name_ids[inside]])
+    distinct = np.ones(len(pairs), dtype=bool)
+    distinct[1:] = pairs[1:] != pairs[:-1]
+    pairs = pairs[distinct]
+    hashes = pairs >> np.uint64(32)
+    first_of_hash = np.ones(len(hashes), dtype=bool)
+    first_of_hash[1:] = hashes[1:] != hashes[:-1]
+    starts = np.flatnonzero(first_of_hash)
+    rows = (pairs & np.uint64(0xFFFFFFFF)).astype(np.int32)
+    return hashes[starts], np.append(starts, len(hashes)), rows
+
+class ReestrIndex:
+    """Inverted index over the reestr names for the first best compare_strings_advanced match."""
+
+    SEPARATOR = '\x00'  # не встречается в ячейках xlsx
+    # Триграммы в названиях слишком частые, списки строк по ним длинные
+    NGRAM_SIZE = 4
+
+    def __init__(self, norms, token_sets, postings=None):
+        """postings are (count_postings, n-gram postings) of these names from load_cached_index."""
+        self.size = len(norms)
+        self.token_counts = [len(tokens) for tokens in token_sets]
+        self.first_by_norm = {}
+        self.norm_lengths = set()
+        self._token_postings = None
+        self.count_postings = {}  # token -> token count -> rows
+        self.norms = norms
+        self.first_valid = None
+        self.first_empty = None
+
+        corpus_parts = []
+        self.corpus_offsets = []
+        offset = 0
+        with gc_paused():
+            for row_pos, (norm, tokens) in enumerate(zip(norms, token_sets)):
+                if norm is None:
+                    continue
+                if self.first_valid is None:
+                    self.first_valid = row_pos
+                if not norm and self.first_empty is None:
+                    self.first_empty = row_pos
+                self.first_by_norm.setdefault(norm, row_pos)
+                self.norm_lengths.add(len(norm))
+                if postings is None:
+                    for token in tokens:
+                        self.count_postings.setdefault(token, {}).setdefault(len(tokens), []).append(row_pos)
+                corpus_parts.append(norm)
+                self.corpus_offsets.append((offset, row_pos))
+                offset += len(norm) + len(self.SEPARATOR)
+
+        self.corpus = self.SEPARATOR.join(corpus_parts)
+        self.corpus_starts = [start for start, _ in self.corpus_offsets]
+        self.norm_lengths = sorted(self.norm_lengths)
+
+        if postings is not None:
+            self.count_postings, (self.ngram_hashes, self.ngram_indptr, self.ngram_rows) = postings
+        else:
+            # Строки с одинаковым именем не нужны: первая из них и так раньше
+            self.ngram_hashes, self.ngram_indptr, self.ngram_rows = build_ngram_postings(
+                self.first_by_norm, self.NGRAM_SIZE)
+
+    @property
+    def token_postings(self):
+        """token -> rows having it, merged from count_postings on first use."""
+        if self._token_postings is None:
+            self._token_postings = {token: sorted(itertools.chain.from_iterable(by_count.values()))
+                                    for token, by_count in self.count_postings.items()}
+        return self._token_postings
+
+    def _first_containing(self, norm):
+        """First row whose normalized name contains norm."""
+        size = self.NGRAM_SIZE
+        if len(norm) >= size:
+            # Имя с norm есть среди строк с любой его n-граммой, берём самую редкую
+            if not len(self.ngram_hashes):
+                return None
+            hashes = hash_ngrams(text_codes(norm), size)
+            slots = self.ngram_hashes.searchsorted(hashes)
+            if (self.ngram_hashes.take(slots, mode='clip') != hashes).any():
+                return None
+            lengths = self.ngram_indptr[slots + 1] - self.ngram_indptr[slots]
+            rarest = slots[lengths.argmin()]
+            norms = self.norms
+            rows = self.ngram_rows[self.ngram_indptr[rarest]:self.ngram_indptr[rarest + 1]].tolist()
+            return next((row_pos for row_pos in rows if norm in norms[row_pos]), None)
+        if self.SEPARATOR in norm:
+            return None
+        found = self.corpus.find(norm)
+        if found < 0:
+            return None
+        return self.corpus_offsets[bisect.bisect_right(self.corpus_starts, found) - 1][1]
+
+    def _first_contained(self, norm):
+        """First row whose normalized name is a substring of norm."""
+        best = None
+        first_by_norm = self.first_by_norm
+        for length in self.norm_lengths:
+            if length == 0:
+                continue
+            if length > len(norm):
+                break
+            for start in range(len(norm) - length + 1):
+                row_pos = first_by_norm.get(norm[start:start + length])
+                if row_pos is not None and (best is None or row_pos < best):
+                    best = row_pos
+        return best
+
+    def best_match(self, norm, tokens):
+        """Return (row position, level) of the best reestr match for a normalized item.
+
+        The position is None when nothing reaches level 1.
+        """
+        if norm is None or self.first_valid is None:
+            return None, 0
+
+        if not norm:
+            # Пустая строка входит в любую другую
+            return self.first_valid, 2
+
+        # Точное совпадение: искать дальше нужно только среди строк до него
+        exact = self.first_by_norm.get(norm)
+        if exact == self.first_valid:
+            return exact, 2
+        return self.resolve(norm, *self.jaccard_match(tokens, exact))
+
+    def jaccard_match(self, tokens, limit=None):
+        """First rows with Jaccard level 2 and level 1 against tokens (or None).
+
+        Only rows before limit are scored when it is given.
+        """
+        level2 = level1 = None
+        counts = Counter()
+        query_count = len(tokens)
+        for token in tokens:
+            for token_count, postings in self.count_postings.get(token, {}).items():
+                if jaccard_possible(query_count, token_count):
+                    if limit is not None:
+                        postings = postings[:bisect.bisect_left(postings, limit)]
+                    counts.update(postings)
+        token_counts = self.token_counts
+        for row_pos, intersection in counts.items():
+            jaccard = intersection / (query_count + token_counts[row_pos] - intersection)
+            if jaccard > JACCARD_LEVEL2:
+                if level2 is None or row_pos < level2:
+                    level2 = row_pos
+            elif jaccard > JACCARD_LEVEL1 and (level1 is None or row_pos < level1):
+                level1 = row_pos
+        return level2, level1
+
+    def resolve(self, norm, jaccard_level2, jaccard_level1):
+        """Combine the Jaccard candidates with the exact and substring rules."""
+        level2 = [row_pos for row_pos in (self.first_empty, self._first_containing(norm),
+                                          self._first_contained(norm), jaccard_level2)
+                  if row_pos is not None]
+        if level2:
+            return min(level2), 2
+        if jaccard_level1 is not None:
+            return jaccard_level1, 1
+        return None, 0
+
+class MatchMemo:
+    """Best matches of the most recently matched normalized item names.
+
+    Sklad tables repeat the same item on many rows, and its best match only
+    depends on the normalized name (the tokens are its words), so a name is
+    matched again only after it dropped out of the last max_size names
+    (MATCH_MEMO_SIZE by default) used. hits and misses count the lookups.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = MATCH_MEMO_SIZE if max_size is None else max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, norm):
+        """Memoized (row position, level) for norm, None when not memoized."""
+        match = self.entries.get(norm)
+        if match is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(norm)
+        return match
+
+    def put(self, norm, match):
+        if self.max_size <= 0:
+            return
+        self.entries[norm] = match
+        self.entries.move_to_end(norm)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def best_match(self, matcher, norm, tokens):
+        """matcher.best_match(norm, tokens), memoized."""
+        match = self.get(norm)
+        if match is None:
+            match = matcher.best_match(norm, tokens)
+            self.put(norm, match)
+        return match
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def log_stats(self):
+        logger.info(f"Match memo: {self.hits} hits, {self.misses} misses, "
+                    f"hit rate {self.hit_rate * 100:.2f}%")
+
+class ProgressReporter:
+    """Reports the stage of a run ('load', 'match', 'write', 'done'), the rows
+    processed so far and an ETA to a callback.
+
+    The callback receives dicts with 'stage', 'done', 'total' and 'eta' (the
+    estimated seconds left in the stage, None while unknown). Stage changes
+    and the last row are always reported, other row counts at most once per
+    PROGRESS_INTERVAL. Without a callback nothing is reported.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.stage = None
+        self.total = None
+        self.done = 0
+        self.started = None
+        self.reported = None
+
+    def start_stage(self, stage, total=None):
+        self.stage = stage
+        self.total = total
+        self.done = 0
+        self.started = monotonic()
+        self._report(self.started)
+
+    def advance(self, done):
+        """Set the number of rows of the stage processed so far."""
+        self.done = done
+        if self.callback is None:
+            return
+        now = monotonic()
+        if done != self.total and now - self.reported < PROGRESS_INTERVAL:
+            return
+        self._report(now)
+
+    def _report(self, now):
+        if self.callback is None:
+            return
+        eta = None
+        if self.total and self.done:
+            eta = round((now - self.started) / self.done * (self.total - self.done), 1)
+        self.reported = now
+        self.callback({'stage': self.stage, 'done': self.done, 'total': self.total, 'eta': eta})
+
+def build_reestr_index(reestr_df):
+    """Build a ReestrIndex over the normalized "Наименование в счёте" column.
+
+    The postings of a cached reestr (see REESTR_VERSION_ATTR) are loaded
+    from its cache entry, or stored there once built.
+    """
+    cache_key = reestr_df.attrs.get(REESTR_VERSION_ATTR) if REESTR_CACHE_DIR else None
+    postings = load_cached_index(cache_key, len(reestr_df)) if cache_key else None
+    reestr_index = ReestrIndex(reestr_df[NORM_COLUMN].tolist(), reestr_df[TOKENS_COLUMN].tolist(), postings)
+    if cache_key and postings is None:
+        store_cached_index(cache_key, reestr_index)
+    logger.info(f"{'Loaded' if postings else 'Built'} reestr index: {len(reestr_index.count_postings)} tokens, "
+                f"{len(reestr_index.first_by_norm)} distinct names")
+    return reestr_index
+
+class ReestrSnapshot:
+    """A loaded reestr with its normalized names and ReestrIndex.
+
+    Snapshots are never changed once built, so runs in several threads can
+    match against the same one; a newer reestr gets a new snapshot.
+    cache_key is the reestr_cache_key of the file it was loaded from.
+    """
+
+    def __init__(self, cache_key, reestr_df, reestr_index):
+        self.cache_key = cache_key
+        self.reestr_df = reestr_df
+        self.reestr_index = reestr_index
+
+def load_reestr_snapshot(reestr_file):
+    """load_reestr and build_reestr_index of reestr_file as a ReestrSnapshot."""
+    reestr_df = load_reestr(reestr_file)
+    cache_key = reestr_df.attrs.get(REESTR_VERSION_ATTR) or reestr_cache_key(reestr_file)
+    return ReestrSnapshot(cache_key, reestr_df, build_reestr_index(reestr_df))
+
+# Reestr index of a match worker process, set by fork or by _init_match_worker,
+# and the worker's MatchMemo
+_worker_index = None
+_worker_memo = None
+
+def _init_match_worker(reestr_index):
+    global _worker_index
+    _worker_index = reestr_index
+
+def _match_chunk(chunk):
+    """Matches of a chunk and the worker's memo hits and misses for it."""
+    global _worker_memo
+    if _worker_memo is None:
+        _worker_memo = MatchMemo()
+    hits, misses = _worker_memo.hits, _worker_memo.misses
+    norms, token_sets = chunk
+    matches = [_worker_memo.best_match(_worker_index, norm, tokens) for norm, tokens in zip(norms, token_sets)]
+    return matches, _worker_memo.hits - hits, _worker_memo.misses - misses
+
+def find_best_matches(reestr_index, norms, token_sets, workers=1, progress=None):
+    """Best (row position, level) in reestr_index for every normalized item.
+
+    With workers > 1 the items are matched in chunks of MATCH_CHUNK_SIZE in a
+    process pool. Workers inherit the index through fork, or receive it once
+    through the pool initializer where fork is not available, so it is not
+    pickled per task. Repeated names are matched once through a MatchMemo
+    (one per worker). The result is in the order of the items. progress (a
+    ProgressReporter) is advanced after every chunk.
+    """
+    progress = progress or ProgressReporter()
+    memo = MatchMemo()
+    chunks = [(norms[start:start + MATCH_CHUNK_SIZE], token_sets[start:start + MATCH_CHUNK_SIZE])
+              for start in range(0, len(norms), MATCH_CHUNK_SIZE)]
+    workers = min(workers, len(chunks))
+    if workers <= 1:
+        matches = []
+        for chunk_norms, chunk_tokens in chunks:
+            matches.extend(memo.best_match(reestr_index, norm, tokens)
+                           for norm, tokens in zip(chunk_norms, chunk_tokens))
+            progress.advance(len(matches))
+        memo.log_stats()
+        return matches
+
+    global _worker_index
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        _worker_index = reestr_index
+        initializer, initargs = None, ()
+    else:
+        context = multiprocessing.get_context()
+        initializer, initargs = _init_match_worker, (reestr_index,)
+
+    logger.info(f"Matching {len(norms)} rows in {len(chunks)} chunks on {workers} workers")
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=initializer, initargs=initargs) as executor:
+            matches = []
+            for chunk_matches, hits, misses in executor.map(_match_chunk, chunks):
+                matches.extend(chunk_matches)
+                memo.hits += hits
+                memo.misses += misses
+                progress.advance(len(matches))
+    finally:
+        _worker_index = None
+    memo.log_stats()
+    return matches
+
+def find_best_matches_sparse(reestr_index, norms, token_sets, progress=None):
+    """find_best_matches with the Jaccard part computed on sparse matrices.
+
+    Item and reestr token sets become binary token-incidence matrices; one
+    product per block of SPARSE_BLOCK_ROWS items gives all intersection
+    sizes, and the Jaccard levels and first best row per item are derived
+    with array operations. Exact and substring matches still come from
+    reestr_index. Names memoized in a MatchMemo and repeated names of a
+    block are left out of the products.
+    """
+    progress = progress or ProgressReporter()
+    memo = MatchMemo()
+    vocabulary = {token: col for col, token in enumerate(reestr_index.token_postings)}
+    postings = list(reestr_index.token_postings.values())
+    reestr_rows = np.fromiter((row_pos for rows in postings for row_pos in rows), dtype=np.int64)
+    reestr_cols = np.repeat(np.arange(len(postings)), [len(rows) for rows in postings])
+    reestr_matrix = sparse.csr_matrix(
+        (np.ones(len(reestr_rows), dtype=np.int32), (reestr_rows, reestr_cols)),
+        shape=(reestr_index.size, len(vocabulary)))
+    reestr_matrix_t = reestr_matrix.T.tocsr()
+    reestr_counts = np.asarray(reestr_index.token_counts, dtype=np.int64)
+
+    matches = []
+    for start in range(0, len(norms), SPARSE_BLOCK_ROWS):
+        # Сопоставляем только новые имена блока, по одному разу
+        block_matches = [memo.get(norm) for norm in norms[start:start + SPARSE_BLOCK_ROWS]]
+        new_positions = {}
+        for pos, match in enumerate(block_matches):
+            if match is None:
+                new_positions.setdefault(norms[start + pos], start + pos)
+        block_norms = list(new_positions)
+        block_tokens = [token_sets[pos] for pos in new_positions.values()]
+        block_size = len(block_norms)
+
+        item_cols = [[vocabulary[token] for token in tokens if token in vocabulary] for tokens in block_tokens]
+        item_rows = np.repeat(np.arange(block_size), [len(cols) for cols in item_cols])
+        item_matrix = sparse.csr_matrix(
+            (np.ones(len(item_rows), dtype=np.int32),
+             (item_rows, np.fromiter((col for cols in item_cols for col in cols), dtype=np.int64))),
+            shape=(block_size, len(vocabulary)))
+        item_counts = np.fromiter((len(tokens) for tokens in block_tokens), dtype=np.int64, count=block_size)
+
+        intersections = (item_matrix @ reestr_matrix_t).tocsr()
+        rows = np.repeat(np.arange(block_size), np.diff(intersections.indptr))
+        cols = intersections.indices.astype(np.int64)
+        inter = intersections.data.astype(np.int64)
+        jaccard = inter / (item_counts[rows] + reestr_counts[cols] - inter)
+
+        # Первая (с наименьшим номером) строка реестра на каждом уровне
+        no_match = reestr_index.size
+        first_level2 = np.full(block_size, no_match, dtype=np.int64)
+        first_level1 = np.full(block_size, no_match, dtype=np.int64)
+        is_level2 = jaccard > JACCARD_LEVEL2
+        is_level1 = (jaccard > JACCARD_LEVEL1) & ~is_level2
+        np.minimum.at(first_level2, rows[is_level2], cols[is_level2])
+        np.minimum.at(first_level1, rows[is_level1], cols[is_level1])
+
+        new_matches = {}
+        for block_pos, norm in enumerate(block_norms):
+            if norm is None or reestr_index.first_valid is None:
+                match = (None, 0)
+            elif not norm:
+                match = (reestr_index.first_valid, 2)
+            else:
+                level2 = int(first_level2[block_pos])
+                level1 = int(first_level1[block_pos])
+                match = reestr_index.resolve(
+                    norm,
+                    level2 if level2 != no_match else None,
+                    level1 if level1 != no_match else None)
+            new_matches[norm] = match
+            memo.put(norm, match)
+        matches.extend(match if match is not None else new_matches[norm]
+                       for norm, match in zip(norms[start:start + SPARSE_BLOCK_ROWS], block_matches))
+        progress.advance(len(matches))
+    memo.log_stats()
+    return matches
+
+class ReestrScan:
+    """Best-match search by scanning the reestr rows in order.
+
+    Needs no index: a reestr name equal to the item is looked up in a dict,
+    and it or the first row containing the item or contained in it ends
+    the scan (nothing after it can win). The Jaccard index is only
+    computed for rows before that one whose token count can reach level 1
+    (see jaccard_possible). The reestr rows are bucketed by token count for
+    this, and a scan stops at the first Jaccard level 2 row.
+    """
+
+    def __init__(self, norms, token_sets):
+        self.token_sets = token_sets
+        self.valid_norms = [(row_pos, norm) for row_pos, norm in enumerate(norms) if norm is not None]
+        self.valid_positions = [row_pos for row_pos, _ in self.valid_norms]
+        self.first_by_norm = {}
+        for row_pos, norm in self.valid_norms:
+            self.first_by_norm.setdefault(norm, row_pos)
+        self.count_buckets = {}
+        for row_pos, norm in self.valid_norms:
+            if token_sets[row_pos]:
+                self.count_buckets.setdefault(len(token_sets[row_pos]), []).append(row_pos)
+        self.candidate_buckets = {}  # token count -> buckets that can reach level 1
+
+    def _candidates(self, tokens):
+        """Reestr rows, in order, whose token count allows a Jaccard level against tokens."""
+        query_count = len(tokens)
+        buckets = self.candidate_buckets.get(query_count)
+        if buckets is None:
+            buckets = [rows for token_count, rows in self.count_buckets.items()
+                       if jaccard_possible(query_count, token_count)]
+            self.candidate_buckets[query_count] = buckets
+        return heapq.merge(*buckets)
+
+    def best_match(self, norm, tokens):
+        """Return (row position, level) of the best reestr match for a normalized item."""
+        if norm is None:
+            return None, 0
+
+        # Первая строка с точным совпадением или по подстроке: дальше уровень не вырастет
+        substring = self.first_by_norm.get(norm)
+        before = self.valid_norms
+        if substring is not None:
+            before = itertools.islice(before, bisect.bisect_left(self.valid_positions, substring))
+        substring = next((row_pos for row_pos, reestr_norm in before
+                          if reestr_norm in norm or norm in reestr_norm), substring)
+
+        level1 = None
+        if tokens:
+            token_sets = self.token_sets
+            for row_pos in self._candidates(tokens):
+                if substring is not None and row_pos >= substring:
+                    break
+                reestr_tokens = token_sets[row_pos]
+                jaccard = len(tokens & reestr_tokens) / len(tokens | reestr_tokens)
+                if jaccard > JACCARD_LEVEL2:
+                    return row_pos, 2
+                if jaccard > JACCARD_LEVEL1 and level1 is None:
+                    level1 = row_pos
+
+        if substring is not None:
+            return substring, 2
+        if level1 is not None:
+            return level1, 1
+        return None, 0
+
+# result_df.attrs key of the count_match_stages counts, set by create_result_dataframe
+MATCH_STAGES_ATTR = 'match_stages'
+
+def match_stage(norm, reestr_norm, level):
+    """Stage that matched an item at level: 'exact' (equal names), 'substring',
+    'jaccard' (level 2), 'partial' (level 1) or 'none'."""
+    if level == 0:
+        return 'none'
+    if level == 1:
+        return 'partial'
+    if reestr_norm == norm:
+        return 'exact'
+    if reestr_norm in norm or norm in reestr_norm:
+        return 'substring'
+    return 'jaccard'
+
+def count_match_stages(norms, reestr_norms, matches):
+    """Number of items resolved by each matching stage (see match_stage).
+
+    matches holds the (reestr row position or None, level) of the items
+    with the normalized names norms.
+    """
+    counts = dict.fromkeys(('exact', 'substring', 'jaccard', 'partial', 'none'), 0)
+    for norm, (row_pos, level) in zip(norms, matches):
+        reestr_norm = reestr_norms[row_pos] if level else None
+        counts[match_stage(norm, reestr_norm, level)] += 1
+    return counts
+
+def _json_value(value):
+    """Reestr cell value as a JSON value (None for empty cells)."""
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, str):
+        return value or None
+    if pd.isna(value):
+        return None
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def match_item_names(names, snapshot):
+    """Best reestr match of each item name (level, stage, score and the reestr row's name, ID and price)."""
+    reestr_df = snapshot.reestr_df
+    columns = {key: reestr_df[col] if col in reestr_df.columns else None
+               for key, col in (('reestr_name', 'Наименование в счёте'),
+                                ('invoice_id', 'ID счёта'), ('price', 'Цена за ед.'))}
+    norms, token_sets, _ = normalize_names(names)
+    results = []
+    for norm, tokens in zip(norms, token_sets):
+        row_pos, level = snapshot.reestr_index.best_match(norm, tokens)
+        match = {'level': level, 'stage': 'none', 'score': 0.0}
+        match.update(dict.fromkeys(columns))
+        if level:
+            reestr_norm = reestr_df[NORM_COLUMN].iat[row_pos]
+            reestr_tokens = reestr_df[TOKENS_COLUMN].iat[row_pos]
+            match['stage'] = match_stage(norm, reestr_norm, level)
+            if match['stage'] in ('exact', 'substring'):
+                match['score'] = 1.0
+            else:
+                match['score'] = round(len(tokens & reestr_tokens) / len(tokens | reestr_tokens), 4)
+            for key, column in columns.items():
+                if column is not None:
+                    match[key] = _json_value(column.iat[row_pos])
+        results.append(match)
+    return results
+
+def find_best_matches_scan(sklad_df, reestr_df, progress=None):
+    """Best (row position, level) in reestr_df for every normalized sklad row.
+
+    The reference matcher: the first reestr row with the highest
+    compare_normalized level, found with a ReestrScan for every distinct
+    name (see MatchMemo).
+    """
+    progress = progress or ProgressReporter()
+    reestr_scan = ReestrScan(reestr_df[NORM_COLUMN].tolist(), reestr_df[TOKENS_COLUMN].tolist())
+    memo = MatchMemo()
+    matches = []
+    for row_pos, (item_norm, item_tokens) in enumerate(
+            zip(sklad_df[NORM_COLUMN].tolist(), sklad_df[TOKENS_COLUMN].tolist())):
+        matches.append(memo.best_match(reestr_scan, item_norm, item_tokens))
+        progress.advance(row_pos + 1)
+    memo.log_stats()
+    return matches
+
+def log_comparison_trace(sklad_df, reestr_df, row_pos):
+    """Log the comparison of the sklad row at row_pos with every reestr row (DEBUG)."""
+    item_name = get_item_names(sklad_df).iloc[row_pos]
+    item_norm = sklad_df[NORM_COLUMN].iloc[row_pos]
+    item_tokens = sklad_df[TOKENS_COLUMN].iloc[row_pos]
+    reestr_names = get_reestr_names(reestr_df).tolist()
+    reestr_norms = reestr_df[NORM_COLUMN].tolist()
+    reestr_tokens = reestr_df[TOKENS_COLUMN].tolist()
+    for reestr_pos, reestr_name in enumerate(reestr_names):
+        logger.debug("Comparing with reestr row %s:", reestr_df.index[reestr_pos])
+        logger.debug("  Exit item: %s", item_name)
+        logger.debug("  Reestr item: %s", reestr_name)
+        similarity = compare_normalized(item_norm, item_tokens, reestr_norms[reestr_pos], reestr_tokens[reestr_pos])
+        logger.debug("  Similarity level: %s", similarity)
+
+# Result columns copied from the matched reestr row
+REESTR_RESULT_COLUMNS = {
+    "ID": "ID счёта",
+    "кол-во": "Кол-во в счёте в Ед. Изм. в счёте",
+    "поставщик": "Компания поставщик",
+    "пп": "Номера платёжных поручений",
+    "дата платежа": "Дата последнего платежа",
+    "цена за ед.": "Цена за ед.",
+}
+
+def _sum_factors(values):
+    """float(value) if value else 0 for the values of a "сумма" factor.
+
+    Returns the factors, where the value was given (truthy) and where
+    float() succeeded.
+    """
+    if values.dtype.kind in 'biuf':
+        factors = values.astype(np.float64)
+        return factors, factors != 0, np.ones(len(values), dtype=bool)
+    factors = np.zeros(len(values))
+    given = np.zeros(len(values), dtype=bool)
+    converted = np.ones(len(values), dtype=bool)
+    for pos, value in enumerate(values):
+        try:
+            if value:
+                given[pos] = True
+                factors[pos] = float(value)
+        except (ValueError, TypeError):
+            converted[pos] = False
+    return factors, given, converted
+
+def assemble_result(sklad_df, reestr_df, matches):
+    """Build the result DataFrame column by column from the matches.
+
+    matches holds the (reestr row position or None, level) of every sklad
+    row. Sklad columns are copied as they are, reestr columns are taken at
+    the matched positions (empty for unmatched rows) and "сумма" is кол-во *
+    цена за ед. of the matched row, 0 when a value is not a number. Column
+    types are inferred as for a frame built from one dict per row.
+    """
+    row_count = len(sklad_df)
+    positions = np.fromiter((-1 if pos is None else pos for pos, _ in matches), dtype=np.int64, count=row_count)
+    levels = np.fromiter((level for _, level in matches), dtype=np.int64, count=row_count)
+    matched = positions >= 0
+    matched_positions = positions[matched]
+
+    columns = {col: np.full(row_count, "", dtype=object) for col in RESULT_COLUMNS}
+    columns["№"] = (sklad_df.index + 1).to_numpy()
+    for result_col, sklad_col in SKLAD_DIRECT_COLUMNS.items():
+        default = 0 if result_col == "кол-во в перемещении" else ""
+        for col in (sklad_col, result_col):
+            if col in sklad_df.columns:
+                columns[result_col] = sklad_df[col].to_numpy()
+                break
+        else:
+            columns[result_col] = np.full(row_count, default, dtype=object)
+    columns["группа"] = np.full(row_count, "Материалы", dtype=object)
+    columns["Соп - ие"] = levels
+
+    sum_factors = []
+    for result_col, reestr_col in REESTR_RESULT_COLUMNS.items():
+        if reestr_col in reestr_df.columns:
+            taken = reestr_df[reestr_col].take(matched_positions)
+            columns[result_col][matched] = taken.astype(object).to_numpy()
+            sum_values = taken.to_numpy()
+        else:
+            sum_values = np.full(len(matched_positions), "", dtype=object)
+        if result_col in ("кол-во", "цена за ед."):
+            sum_factors.append(_sum_factors(sum_values))
+
+    (kol_vo, kol_vo_given, kol_vo_ok), (cena, cena_given, cena_ok) = sum_factors
+    sums = (kol_vo * cena).astype(object)
+    # 0 * 0 без чисел даёт целый 0, как и ошибка преобразования
+    sums[~(kol_vo_given | cena_given) | ~(kol_vo_ok & cena_ok)] = 0
+    columns["сумма"][matched] = sums
+    for idx in sklad_df.index[matched][~(kol_vo_ok & cena_ok)]:
+        logger.warning(f"Could not calculate sum for row {idx + 1}")
+
+    return pd.DataFrame(columns, index=pd.RangeIndex(row_count), columns=RESULT_COLUMNS).infer_objects()
+
+def create_result_dataframe(sklad_df, reestr_df, engine=None, workers=None, progress=None, reestr_index=None,
+                            incremental=None):
+    """Create the result DataFrame based on the transformation algorithm.
+
+    engine is 'index', 'parallel', 'sparse' or 'scan' (MATCH_ENGINE); a given reestr_index is reused.
+    """
+    progress = progress or ProgressReporter()
+    progress.start_stage('match', len(sklad_df))
+    engine = engine or MATCH_ENGINE
+    incremental = MATCH_INCREMENTAL if incremental is None else incremental
+    if engine == 'sparse' and sparse is None:
+        logger.warning("SciPy не установлен, используем движок 'index' вместо 'sparse'")
+        engine = 'index'
+
     # Debug logging
     logger.info("Starting data transformation")
     logger.info(f"Number of rows in sklad: {len(sklad_df)}")
     logger.info(f"Number of rows in reestr: {len(reestr_df)}")
-    
-    # Step 2: Populate initial data from sklad_df
-    for idx, row in sklad_df.iterrows():
-        # Initialize result row with empty values
-        result_row = {col: "" for col in RESULT_COLUMNS}
-        
-        # Copy data from sklad - try both renamed and original column names
-        result_row["№"] = idx + 1
-        result_row["код"] = row.get("Номенклатура.Код", row.get("код", ""))
-        result_row["предмет"] = row.get("Номенклатура.Наименование", row.get("предмет", ""))
-        result_row["ед.изм"] = row.get("Единица", row.get("ед.изм", ""))
-        result_row["плательщик"] = row.get("Документ связи.Организация", row.get("плательщик", ""))
-        result_row["№ перемещения"] = row.get("Регистратор.Номер", row.get("№ перемещения", ""))
-        result_row["дата перемещения"] = row.get("Период, день.Начало дня", row.get("дата перемещения", ""))
-        result_row["кол-во в перемещении"] = row.get("Количество Приход", row.get("кол-во в перемещении", 0))
-        result_row["группа"] = "Материалы"
-        
-        # Log first row data for debugging
-        if idx == 0:
-            logger.info(f"First row from sklad: {result_row}")
-            logger.info(f"Available sklad columns: {list(row.index)}")
-            logger.info(f"Sample row data: {dict(row)}")
-            logger.info(f"Looking for match in reestr for: {result_row['предмет']}")
-            
-            # Check if key columns are empty
-            if not result_row['предмет']:
-                logger.warning("ВНИМАНИЕ: Колонка 'предмет' пустая! Проверьте маппинг колонок.")
-            if not result_row['код']:
-                logger.warning("ВНИМАНИЕ: Колонка 'код' пустая! Проверьте маппинг колонок.")
-        
-        # Step 3: Find matching row in reestr_df
-        match_level = 0
-        matched_row = None
-        best_similarity = 0
-        
-        # Get the item name from exit table (column D - "предмет")
-        item_name = result_row["предмет"]
-        
-        # Search in reestr table column 6 ("Наименование в счёте")
-        for reestr_idx, reestr_row in reestr_df.iterrows():
-            reestr_name = reestr_row.get("Наименование в счёте", "")
-            
-            # Log comparison details for first row
-            if idx == 0:
-                logger.info(f"Comparing with reestr row {reestr_idx}:")
-                logger.info(f"  Exit item: {item_name}")
-                logger.info(f"  Reestr item: {reestr_name}")
-            
-            # Compare strings
-            similarity = compare_strings_advanced(item_name, reestr_name)
-            
-            if idx == 0:
-                logger.info(f"  Similarity level: {similarity}")
-            
-            if similarity > match_level:
-                match_level = similarity
-                matched_row = reestr_row
-                best_similarity = similarity
-        
-        # Step 4: If match found, copy data from matched reestr row
-        if matched_row is not None and match_level > 0:
-            # Copy data from matched reestr row to result row
-            result_row["ID"] = matched_row.get("ID счёта", "")
-            result_row["кол-во"] = matched_row.get("Кол-во в счёте в Ед. Изм. в счёте", "")
-            result_row["поставщик"] = matched_row.get("Компания поставщик", "")
-            result_row["пп"] = matched_row.get("Номера платёжных поручений", "")
-            result_row["дата платежа"] = matched_row.get("Дата последнего платежа", "")
-            result_row["цена за ед."] = matched_row.get("Цена за ед.", "")
-            
-            # Calculate sum if both values are numeric
-            try:
-                kol_vo = float(result_row["кол-во"]) if result_row["кол-во"] else 0
-                cena = float(result_row["цена за ед."]) if result_row["цена за ед."] else 0
-                result_row["сумма"] = kol_vo * cena
-            except (ValueError, TypeError):
-                result_row["сумма"] = 0
-                logger.warning(f"Could not calculate sum for row {idx + 1}")
-        
-        # Set match level
-        result_row["Соп - ие"] = match_level
-        
-        # Log first row after all processing
-        if idx == 0:
-            logger.info(f"Final first row data: {result_row}")
-        
-        result_data.append(result_row)
-    
-    result_df = pd.DataFrame(result_data, columns=RESULT_COLUMNS)
-    
+    logger.info(f"Match engine: {engine}")
+
+    matching_started = monotonic()
+    prepare_normalized(sklad_df, reestr_df)
+    if engine == 'parallel':
+        workers = workers or MATCH_WORKERS
+    else:
+        workers = 1
+
+    def match_rows(norms, token_sets):
+        if not norms:
+            return []
+        index = reestr_index or build_reestr_index(reestr_df)
+        if engine == 'sparse':
+            return find_best_matches_sparse(index, norms, token_sets, progress)
+        return find_best_matches(index, norms, token_sets, workers, progress)
+
+    if engine in ('index', 'parallel', 'sparse'):
+        if incremental:
+            matches = find_matches_incremental(sklad_df, reestr_df, match_rows, progress)
+        else:
+            matches = match_rows(sklad_df[NORM_COLUMN].tolist(), sklad_df[TOKENS_COLUMN].tolist())
+    else:
+        matches = find_best_matches_scan(sklad_df, reestr_df, progress)
+    record_stage('matching', monotonic() - matching_started)
+
+    with timed_stage('assembly'):
+        result_df = assemble_result(sklad_df, reestr_df, matches)
+
+    # Check if key columns of the first row are empty
+    for row_pos in np.flatnonzero(sklad_df.index == 0):
+        if not result_df.at[row_pos, 'предмет']:
+            logger.warning("ВНИМАНИЕ: Колонка 'предмет' пустая! Проверьте маппинг колонок.")
+        if not result_df.at[row_pos, 'код']:
+            logger.warning("ВНИМАНИЕ: Колонка 'код' пустая! Проверьте маппинг колонок.")
+
+    # Verbose debug: trace of the DEBUG_TRACE_ROW row
+    if VERBOSE_DEBUG and logger.isEnabledFor(logging.DEBUG):
+        for row_pos in np.flatnonzero(sklad_df.index == DEBUG_TRACE_ROW):
+            logger.debug("Available sklad columns: %s", list(sklad_df.columns))
+            logger.debug("Looking for match in reestr for: %s", result_df.at[row_pos, 'предмет'])
+            log_comparison_trace(sklad_df, reestr_df, row_pos)
+            logger.debug("  Best match: reestr row %s, level %s", *matches[row_pos])
+            logger.debug("Final row data: %s", result_df.iloc[row_pos].to_dict())
+
     # Log summary statistics
     total_rows = len(result_df)
     matched_rows = len(result_df[result_df["Соп - ие"] > 0])
     logger.info(f"Total rows processed: {total_rows}")
     logger.info(f"Rows with matches: {matched_rows}")
     logger.info(f"Match rate: {(matched_rows/total_rows)*100:.2f}%")
+    stage_counts = count_match_stages(sklad_df[NORM_COLUMN].tolist(), reestr_df[NORM_COLUMN].tolist(), matches)
+    logger.info("Matches by stage: " + ", ".join(f"{stage} {count}" for stage, count in stage_counts.items()))
+    result_df.attrs[MATCH_STAGES_ATTR] = stage_counts
     
     return result_df
 
+def job_summary(sklad_df, reestr_df, result_df, timings):
+    """Row counts, match-level histogram and stage timings (stage_timings) of a run."""
+    levels = result_df["Соп - ие"]
+    return {
+        'rows': {'sklad': len(sklad_df), 'reestr': len(reestr_df), 'matched': int((levels > 0).sum())},
+        'match_levels': {str(level): int((levels == level).sum()) for level in (0, 1, 2)},
+        'match_stages': result_df.attrs.get(MATCH_STAGES_ATTR, {}),
+        'timings': {stage: round(seconds, 3) for stage, seconds in timings.items()},
+    }
+
+# Number formats df.to_excel uses for dates
+EXCEL_DATETIME_FORMAT = 'YYYY-MM-DD HH:MM:SS'
+EXCEL_DATE_FORMAT = 'YYYY-MM-DD'
+
+def _excel_cell_value(value):
+    """Value and number format of a result cell as df.to_excel stores it.
+
+    Empty values become None, floats are rounded to the 16 digits openpyxl
+    stores (integral ones become int) and dates datetimes, which is what
+    openpyxl reads back from the saved file.
+    """
+    if value is None or value == "" or (pd.api.types.is_scalar(value) and pd.isna(value)):
+        return None, None
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value), None
+    if isinstance(value, (int, np.integer)):
+        return int(value), None
+    if isinstance(value, (float, np.floating)):
+        if np.isinf(value):
+            return ('inf' if value > 0 else '-inf'), None
+        # openpyxl сохраняет числа с 16 значащими цифрами
+        value = float('%.16g' % value)
+        return (int(value) if value.is_integer() else value), None
+    if isinstance(value, datetime):
+        return value, EXCEL_DATETIME_FORMAT
+    if isinstance(value, date):
+        return datetime.combine(value, time()), EXCEL_DATE_FORMAT
+    return str(value), None
+
+def register_result_styles(wb, styles):
+    """Add the header and body styles of the result sheet to wb as named styles."""
+    style_names = {
+        'header': NamedStyle(name='result_header', font=styles['header_font'], fill=styles['header_fill'],
+                             border=styles['header_border'],
+                             alignment=Alignment(horizontal='center', vertical='center')),
+        None: NamedStyle(name='result_body', font=styles['body_font'], border=styles['body_border']),
+        EXCEL_DATETIME_FORMAT: NamedStyle(name='result_body_datetime', font=styles['body_font'],
+                                          border=styles['body_border'], number_format=EXCEL_DATETIME_FORMAT),
+        EXCEL_DATE_FORMAT: NamedStyle(name='result_body_date', font=styles['body_font'],
+                                      border=styles['body_border'], number_format=EXCEL_DATE_FORMAT),
+    }
+    for named_style in style_names.values():
+        wb.add_named_style(named_style)
+    return {key: named_style.name for key, named_style in style_names.items()}
+
 def apply_excel_formatting(df, output_file, styles):
-    """Save the DataFrame to Excel with formatting from the source file."""
-    df.to_excel(output_file, index=False, engine='openpyxl')
-    
-    wb = openpyxl.load_workbook(output_file)
-    ws = wb.active
-    
+    """Save the DataFrame to Excel with formatting from the source file.
+
+    The sheet is written once in openpyxl write-only mode: cell values are
+    converted per column, column widths (longest text + 2) are computed on
+    the converted columns and every cell gets one of the named styles.
+    The time until the workbook is saved counts as 'styling', saving as
+    'save' (see record_stage).
+    """
+    started = monotonic()
+    values, formats = {}, {}
+    for col in df.columns:
+        converted = [_excel_cell_value(value) for value in df[col].tolist()]
+        values[col] = [value for value, _ in converted]
+        formats[col] = [fmt for _, fmt in converted]
+    cells_df = pd.DataFrame(values, columns=df.columns, dtype=object)
+
+    # Adjust column widths
+    header_lengths = pd.Series([len(str(col)) for col in df.columns], index=df.columns)
+    if len(cells_df):
+        max_lengths = cells_df.astype(str).apply(lambda col: col.str.len().max())
+        max_lengths = np.maximum(max_lengths, header_lengths)
+    else:
+        max_lengths = header_lengths
+
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet('Sheet1')
+    style_names = register_result_styles(wb, styles)
+    for col_idx, max_length in enumerate(max_lengths, 1):
+        ws.column_dimensions[get_column_letter(col_idx)].width = int(max_length) + 2
+
+    def make_cell(value, style_name):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style_name
+        return cell
+
     # Apply header formatting
-    for col_idx, col_name in enumerate(df.columns, 1):
-        cell = ws.cell(row=1, column=col_idx)
-        cell.font = styles['header_font']
-        cell.fill = styles['header_fill']
-        cell.border = styles['header_border']
-        cell.alignment = Alignment(horizontal='center', vertical='center')
-    
+    ws.append([make_cell(col_name, style_names['header']) for col_name in df.columns])
+
     # Apply body formatting
-    for row_idx in range(2, ws.max_row + 1):
-        for col_idx in range(1, ws.max_column + 1):
-            cell = ws.cell(row=row_idx, column=col_idx)
-            cell.font = styles['body_font']
-            cell.border = styles['body_border']
-    
-    # Adjust column widths
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = max_length + 2
-        ws.column_dimensions[column].width = adjusted_width
-    
-    wb.save(output_file)
+    columns = [(values[col], formats[col]) for col in df.columns]
+    for row_pos in range(len(df)):
+        ws.append([make_cell(col_values[row_pos], style_names[col_formats[row_pos]])
+                   for col_values, col_formats in columns])
+
+    record_stage('styling', monotonic() - started)
+    with timed_stage('save'):
+        wb.save(output_file)
 
-def main():
-    """Main function to execute the data transformation."""
+def result_settings():
+    """Settings the result of main() depends on besides the input files."""
+    return {
+        'version': RESULT_VERSION,
+        'match_engine': MATCH_ENGINE,
+        'excel_loader': EXCEL_LOADER,
+        'excel_engine': get_excel_engine(),
+        'columns': RESULT_COLUMNS,
+    }
+
+def main(sklad_file=None, reestr_file=None, result_file=None, progress_callback=None, reestr=None):
+    """Main function to execute the data transformation.
+
+    A given reestr (ReestrSnapshot) is matched instead of loading reestr_file; returns the job_summary.
+    """
+    sklad_file = sklad_file or SKLAD_FILE
+    reestr_file = reestr_file or REESTR_FILE
+    result_file = result_file or RESULT_FILE
+    progress = ProgressReporter(progress_callback)
+    stage_timings().clear()
+    started = monotonic()
     try:
         # Load data
-        sklad_df, reestr_df = load_excel_files()
+        progress.start_stage('load')
+        with timed_stage('load'):
+            if reestr is None:
+                sklad_df, reestr_df = load_excel_files(sklad_file, reestr_file)
+                reestr_index = None
+            else:
+                sklad_df = load_sklad_file(sklad_file)
+                reestr_df, reestr_index = reestr.reestr_df, reestr.reestr_index
+                log_loaded_samples(sklad_df, reestr_df)
+            prepare_normalized(sklad_df, reestr_df)
         
         # Get formatting styles from sklad.xlsx
-        styles = get_excel_styles(SKLAD_FILE)
+        with timed_stage('styling'):
+            styles = get_excel_styles(sklad_file)
         
         # Create result DataFrame
-        result_df = create_result_dataframe(sklad_df, reestr_df)
+        result_df = create_result_dataframe(sklad_df, reestr_df, progress=progress, reestr_index=reestr_index)
         
         # Save result with formatting
-        apply_excel_formatting(result_df, RESULT_FILE, styles)
+        progress.start_stage('write')
+        apply_excel_formatting(result_df, result_file, styles)
+        progress.start_stage('done')
+        record_stage('total', monotonic() - started)
+
+        summary = job_summary(sklad_df, reestr_df, result_df, stage_timings())
+        logger.info("Job summary: %s", json.dumps(summary, ensure_ascii=False))
         
-        print(f"Result file created successfully at {RESULT_FILE}")
+        print(f"Result file created successfully at {result_file}")
+        return summary
         
     except Exception as e:
         print(f"Error: {e}")